@@ -1,18 +1,62 @@
 import os
-from flask import Flask, jsonify
-from google.cloud import datastore
-from authlib.integrations.flask_client import OAuth
+from .startup import Startup
+
+# first, so it can time the rest of the imports
+startup = Startup()
+
+with startup.timed("import", "flask"):
+    from flask import Flask, Request as FlaskRequest, jsonify
+with startup.timed("import", "authlib"):
+    from authlib.integrations.flask_client import OAuth
+with startup.timed("import", "app"):
+    from .jwks import JWKSStore
+    from .cache import LRUCache, ResponseCache
+    from .tasks import TaskQueue
+    from .store import Store
+    from .metrics import Metrics
+    from .fanout import FanOut
+    from .auth0 import TokenBroker
+    from .deadline import Deadline, DeadlineExceeded
 
-client = datastore.Client()
 oauth = OAuth()
+key_store = JWKSStore()
+token_cache = LRUCache()
+principal_cache = LRUCache()
+course_cache = ResponseCache()
+tasks = TaskQueue()
+store = Store()
+metrics = Metrics()
+fanout = FanOut()
+broker = TokenBroker()
+deadline = Deadline()
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
         self.status_code = status_code
 
+class Request(FlaskRequest):
+    """
+    Lets a view cap its own body: set request.max_content_length before
+    touching request.files/form/stream and a bigger body, chunked or not,
+    stops with a 413 while being read. Flask 3.0's is read-only.
+    """
+    _max_content_length = None
+
+    @property
+    def max_content_length(self):
+        if self._max_content_length is not None:
+            return self._max_content_length
+
+        return super().max_content_length
+
+    @max_content_length.setter
+    def max_content_length(self, value):
+        self._max_content_length = value
+
 def create_app():
     app = Flask(__name__)
+    app.request_class = Request
 
     # error
     @app.errorhandler(AuthError)
@@ -21,17 +65,126 @@ def create_app():
         response.status_code = ex.status_code
         return response
 
+    # 503 - out of time budget for backend calls
+    @app.errorhandler(DeadlineExceeded)
+    def handle_deadline(ex):
+        from .utility import out_of_time
+        deadline.exceeded()
+        return out_of_time()
+
     # configure app with environment variables
     app.config['CLIENT_ID'] = os.getenv('CLIENT_ID')
     app.config['CLIENT_SECRET'] = os.getenv('CLIENT_SECRET')
     app.config['DOMAIN'] = os.getenv('DOMAIN')
     app.config['ALGORITHMS'] = os.getenv('ALGORITHMS')
+    app.config['BACKEND'] = os.getenv('BACKEND', 'cloud')
+    app.config['MEMORY_LATENCY_MS'] = float(os.getenv('MEMORY_LATENCY_MS', 0))
+    app.config['MEMORY_JITTER_MS'] = float(os.getenv('MEMORY_JITTER_MS', 0))
+    app.config['JWKS_TTL'] = int(os.getenv('JWKS_TTL', 600))
+    app.config['JWKS_MIN_REFRESH'] = int(os.getenv('JWKS_MIN_REFRESH', 30))
+    app.config['JWKS_TIMEOUT'] = float(os.getenv('JWKS_TIMEOUT', 5))
+    app.config['TOKEN_CACHE_SIZE'] = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+    app.config['TOKEN_CACHE_TTL'] = int(os.getenv('TOKEN_CACHE_TTL', 300))
+    app.config['PRINCIPAL_CACHE_SIZE'] = int(os.getenv('PRINCIPAL_CACHE_SIZE', 1024))
+    app.config['PRINCIPAL_CACHE_TTL'] = int(os.getenv('PRINCIPAL_CACHE_TTL', 60))
+    app.config['COURSE_CACHE_SIZE'] = int(os.getenv('COURSE_CACHE_SIZE', 1024))
+    app.config['COURSE_CACHE_TTL'] = int(os.getenv('COURSE_CACHE_TTL', 60))
+    app.config['COURSE_MAX_AGE'] = int(os.getenv('COURSE_MAX_AGE', 30))
+    app.config['TASK_WORKERS'] = int(os.getenv('TASK_WORKERS', 2))
+    app.config['CASCADE_INLINE_LIMIT'] = int(os.getenv('CASCADE_INLINE_LIMIT', 500))
+    app.config['AVATAR_BUCKET'] = os.getenv('AVATAR_BUCKET', 'cs-tarpaulin')
+    app.config['STORAGE_POOL_SIZE'] = int(os.getenv('STORAGE_POOL_SIZE', 10))
+    app.config['AVATAR_DELIVERY'] = os.getenv('AVATAR_DELIVERY', 'stream')
+    app.config['AVATAR_URL_EXPIRY'] = int(os.getenv('AVATAR_URL_EXPIRY', 300))
+    app.config['AVATAR_MAX_AGE'] = int(os.getenv('AVATAR_MAX_AGE', 60))
+    app.config['AVATAR_CHUNK_SIZE'] = int(os.getenv('AVATAR_CHUNK_SIZE', 256 * 1024))
+    app.config['AVATAR_CACHE_BYTES'] = int(os.getenv('AVATAR_CACHE_BYTES', 32 * 1024 * 1024))
+    app.config['AVATAR_CACHE_MAX_ITEM'] = int(os.getenv('AVATAR_CACHE_MAX_ITEM', 1024 * 1024))
+    app.config['AVATAR_CACHE_DIR'] = os.getenv('AVATAR_CACHE_DIR')
+    # /tmp is instance memory on App Engine, only spill when given a real directory
+    app.config['AVATAR_DISK_CACHE_BYTES'] = int(os.getenv('AVATAR_DISK_CACHE_BYTES',
+                                                          256 * 1024 * 1024 if app.config['AVATAR_CACHE_DIR'] else 0))
+    app.config['AVATAR_MAX_BYTES'] = int(os.getenv('AVATAR_MAX_BYTES', 5 * 1024 * 1024))
+    app.config['AVATAR_SIZES'] = [int(size) for size in os.getenv('AVATAR_SIZES', '64,256').split(',')]
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+    app.config['AUTH0_CONNECT_TIMEOUT'] = float(os.getenv('AUTH0_CONNECT_TIMEOUT', 3.05))
+    app.config['AUTH0_READ_TIMEOUT'] = float(os.getenv('AUTH0_READ_TIMEOUT', 10))
+    app.config['AUTH0_RETRIES'] = int(os.getenv('AUTH0_RETRIES', 2))
+    app.config['AUTH0_BACKOFF'] = float(os.getenv('AUTH0_BACKOFF', 0.2))
+    app.config['AUTH0_BREAKER_THRESHOLD'] = int(os.getenv('AUTH0_BREAKER_THRESHOLD', 5))
+    app.config['AUTH0_BREAKER_RESET'] = int(os.getenv('AUTH0_BREAKER_RESET', 30))
+    app.config['AUTH0_POOL_SIZE'] = int(os.getenv('AUTH0_POOL_SIZE', 10))
+    app.config['FANOUT_WORKERS'] = int(os.getenv('FANOUT_WORKERS', 32))
+    app.config['ASGI_WORKERS'] = int(os.getenv('ASGI_WORKERS', 64))
+    app.config['REQUEST_DEADLINE'] = float(os.getenv('REQUEST_DEADLINE', 10))
+    app.config['DEADLINES'] = {endpoint: float(seconds) for endpoint, seconds in
+                               (item.split('=') for item in os.getenv('DEADLINES', '').split(',') if item)}
+    app.config['HEDGE_READS'] = os.getenv('HEDGE_READS', 'false').lower() == 'true'
+    app.config['HEDGE_MIN_DELAY_MS'] = float(os.getenv('HEDGE_MIN_DELAY_MS', 5))
+    app.config['HEDGE_WORKERS'] = int(os.getenv('HEDGE_WORKERS', 16))
+
+    # backends take their call timeouts from the request's budget
+    store.deadline = deadline
+
+    # backend clients connect on first use (or /_ah/warmup), not here
+    for name, extension in [("oauth", oauth), ("jwks", key_store), ("tasks", tasks),
+                            ("deadline", deadline), ("store", store), ("metrics", metrics),
+                            ("fanout", fanout), ("auth0", broker)]:
+        with startup.timed("init", name):
+            extension.init_app(app)
 
-    oauth.init_app(app)
+    # outbound call timings for Server-Timing and /metrics
+    key_store.record = metrics.record
+    store.record = metrics.record
+    broker.record = metrics.record
+    metrics.add_counters("auth0", broker.counters)
+    metrics.add_counters("deadline", deadline.counters)
 
-    from .routes import users, courses, auth
-    app.register_blueprint(users.bp)
-    app.register_blueprint(courses.bp)
-    app.register_blueprint(auth.bp)
+    # cache effectiveness
+    for name, cache in [("token_cache", token_cache), ("principal_cache", principal_cache),
+                        ("course_cache", course_cache.entries)]:
+        metrics.add_counters(name, cache.stats, gauges=("size", "maxsize"))
+
+    # Cloud Storage calls and the avatar cache, whatever the backend keeps
+    for name, collect, gauges in store.avatars.collectors():
+        metrics.add_counters(name, collect, gauges=gauges)
+
+    # verified tokens are only good while the key that signed them is
+    token_cache.maxsize = app.config['TOKEN_CACHE_SIZE']
+    key_store.on_rotate(token_cache.clear)
+
+    principal_cache.maxsize = app.config['PRINCIPAL_CACHE_SIZE']
+    principal_cache.ttl = app.config['PRINCIPAL_CACHE_TTL']
+    store.on_user_change(principal_cache.delete)
+
+    # public course reads, invalidated by version bumps on writes
+    course_cache.entries.maxsize = app.config['COURSE_CACHE_SIZE']
+    course_cache.entries.ttl = app.config['COURSE_CACHE_TTL']
+
+    with startup.timed("init", "routes"):
+        from .routes import users, courses, bulk, auth, monitoring, warmup
+        app.register_blueprint(users.bp)
+        app.register_blueprint(courses.bp)
+        app.register_blueprint(bulk.bp)
+        app.register_blueprint(auth.bp)
+        app.register_blueprint(monitoring.bp)
+        app.register_blueprint(warmup.bp)
+
+    # maintenance commands (flask --app main <command>)
+    from . import commands
+    app.cli.add_command(commands.migrate_enrollments)
+    app.cli.add_command(commands.rebuild_course_index)
+    app.cli.add_command(commands.check_course_index)
+    app.cli.add_command(commands.startup_report)
 
     return app
+
+def create_asgi_app():
+    """
+    create_app for ASGI servers: one process keeps ASGI_WORKERS requests in
+    flight instead of one per WSGI worker thread.
+    """
+    from .asgi import ASGIAdapter
+
+    app = create_app()
+    return ASGIAdapter(app, workers=app.config['ASGI_WORKERS'])
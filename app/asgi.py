@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+# responses up to this size are read in one go on the worker thread
+BUFFER_LIMIT = 64 * 1024
+
+_DONE = object()
+
+class ASGIAdapter:
+    """
+    Serves the WSGI app to an ASGI server (uvicorn asgi:app).\n
+    The event loop owns the connections and each request runs on a bounded
+    thread pool, so one worker process keeps up to `workers` requests in
+    flight while they wait on Datastore, GCS or Auth0. asgiref's WsgiToAsgi
+    isn't used because it runs every request on a single thread.
+    """
+    def __init__(self, wsgi_app, workers=64):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] != "http":
+            raise ValueError(f"unsupported ASGI scope {scope['type']}")
+
+        with SpooledTemporaryFile(max_size=BUFFER_LIMIT) as body:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+
+            body.seek(0)
+            await self.respond(self.environ(scope, body), send)
+
+    async def respond(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        # every call for this request runs in one context, whichever pool
+        # thread picks it up, so stream_with_context bodies keep the request
+        context = contextvars.copy_context()
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                  for name, value in headers]
+
+        def run():
+            iterable = self.wsgi_app(environ, start_response)
+            headers = dict(started["headers"])
+
+            # small bodies come back whole, no thread hop per chunk
+            length = headers.get(b"content-length")
+            if length is not None and int(length) <= BUFFER_LIMIT:
+                try:
+                    return (list(iterable), None)
+                finally:
+                    close(iterable)
+
+            return (None, iterable)
+
+        chunks, iterable = await loop.run_in_executor(self.executor, context.run, run)
+
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": started["headers"]
+        })
+
+        if chunks is not None:
+            await send({"type": "http.response.body", "body": b"".join(chunks)})
+            return
+
+        try:
+            iterator = iter(iterable)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, context.run,
+                                                   next, iterator, _DONE)
+                if chunk is _DONE:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await loop.run_in_executor(self.executor, context.run, close, iterable)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def environ(self, scope, body):
+        """
+        The WSGI environ for an ASGI http scope.
+        """
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+            "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            # the body is already all read, chunked uploads included
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False
+        }
+
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+                key = name
+            else:
+                key = f"HTTP_{name}"
+
+            # repeated headers fold into one, comma separated
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        return environ
+
+def close(iterable):
+    if hasattr(iterable, "close"):
+        iterable.close()
@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# worth another try: Auth0 overloaded or briefly down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class Auth0Error(Exception):
+    """
+    Auth0 failed or answered with something unusable (502).
+    """
+
+class LoginRejected(Auth0Error):
+    """
+    Auth0 turned the username/password down (401).
+    """
+
+class Auth0Unavailable(Auth0Error):
+    """
+    The circuit is open, Auth0 isn't being called right now (503).
+    """
+
+class TokenBroker:
+    """
+    Resource-owner password grants against Auth0's /oauth/token.\n
+    One keep-alive session per process with strict connect/read timeouts.
+    5xx, 429 and connection errors are retried with full-jitter backoff.
+    After AUTH0_BREAKER_THRESHOLD failed logins in a row the circuit
+    opens and logins fail fast for AUTH0_BREAKER_RESET seconds. Then one
+    trial call decides whether it closes again.
+    """
+    def __init__(self):
+        self.session = None
+        self.url = None
+        self.client_id = None
+        self.client_secret = None
+        self.timeout = (3.05, 10)
+        self.retries = 2
+        self.backoff = 0.2
+        self.threshold = 5
+        self.reset = 30
+        self.record = None
+        self._failures = 0
+        self._opened = None
+        self._trial = None
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ["logins", "tokens", "rejected", "errors", "attempts", "retries",
+             "timeouts", "short_circuited", "circuit_opened"], 0)
+
+    def init_app(self, app):
+        self.url = f"https://{app.config.get('DOMAIN')}/oauth/token"
+        self.client_id = app.config.get('CLIENT_ID')
+        self.client_secret = app.config.get('CLIENT_SECRET')
+        self.timeout = (app.config.get('AUTH0_CONNECT_TIMEOUT', 3.05),
+                        app.config.get('AUTH0_READ_TIMEOUT', 10))
+        self.retries = app.config.get('AUTH0_RETRIES', self.retries)
+        self.backoff = app.config.get('AUTH0_BACKOFF', self.backoff)
+        self.threshold = app.config.get('AUTH0_BREAKER_THRESHOLD', self.threshold)
+        self.reset = app.config.get('AUTH0_BREAKER_RESET', self.reset)
+
+        pool_size = app.config.get('AUTH0_POOL_SIZE', 10)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def warm(self):
+        """
+        Opens a keep-alive connection to Auth0 so the first login skips the
+        TCP and TLS handshakes. Any answer will do.
+        """
+        start = time.perf_counter()
+        try:
+            self.session.head(self.url, timeout=self.timeout)
+        finally:
+            if self.record is not None:
+                self.record("auth0", time.perf_counter() - start)
+
+    def password_grant(self, username, password):
+        """
+        Returns the id_token for username/password. Raises LoginRejected,
+        Auth0Unavailable or Auth0Error.
+        """
+        self._count("logins")
+        self._allow()
+
+        body = {
+            'grant_type': 'password',
+            'username': username,
+            'password': password,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retries")
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            try:
+                response = self._post(body)
+            except requests.RequestException:
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                continue
+
+            # Auth0 answered, whatever it said it isn't down
+            self._succeeded()
+
+            if response.status_code in (401, 403):
+                self._count("rejected")
+                raise LoginRejected(response.status_code)
+
+            token = None
+            if response.status_code == 200:
+                try:
+                    token = response.json().get('id_token')
+                except ValueError:
+                    pass
+
+            if not token:
+                self._count("errors")
+                raise Auth0Error(response.status_code)
+
+            self._count("tokens")
+            return token
+
+        self._count("errors")
+        self._failed()
+        raise Auth0Error("retries exhausted")
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _post(self, body):
+        self._count("attempts")
+        start = time.perf_counter()
+        try:
+            return self.session.post(self.url, json=body, timeout=self.timeout)
+        except requests.Timeout:
+            self._count("timeouts")
+            raise
+        finally:
+            if self.record is not None:
+                self.record("auth0", time.perf_counter() - start)
+
+    def _allow(self):
+        with self._lock:
+            if self._opened is None:
+                return
+
+            # half open - one trial call, everyone else keeps failing fast
+            now = time.monotonic()
+            if now - self._opened >= self.reset and (self._trial is None or now - self._trial >= self.reset):
+                self._trial = now
+                return
+
+            self._counters["short_circuited"] += 1
+
+        raise Auth0Unavailable()
+
+    def _succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = None
+
+    def _failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial is not None or (self._opened is None and self._failures >= self.threshold):
+                if self._opened is None:
+                    self._counters["circuit_opened"] += 1
+                self._opened = time.monotonic()
+            self._trial = None
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
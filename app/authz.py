@@ -0,0 +1,124 @@
+import functools
+import inspect
+from collections import namedtuple
+from flask import g, request
+from app import AuthError
+from app.utility import (ERROR, verify_jwt, principal, load_user, load_course,
+                         no_result, no_id_found)
+
+# id and role are None when no user has the JWT's sub
+Caller = namedtuple("Caller", ["sub", "id", "role"])
+
+def current_caller():
+    """
+    The request's Caller, resolved once and kept in g. None if the JWT is
+    missing or invalid.
+    """
+    if "caller" not in g:
+        try:
+            sub = verify_jwt(request).get("sub")
+        except AuthError:
+            g.caller = None
+        else:
+            user = principal(sub)
+            g.caller = Caller(sub, *user) if user else Caller(sub, None, None)
+
+    return g.caller
+
+def authorize(rules, view_args):
+    """
+    Authenticates the request (401) and checks each rule(caller, view_args)
+    in order, stopping at the first error response one returns. Entities a
+    rule loads go into g.resolved for the view.
+    """
+    caller = current_caller()
+    # 401 error
+    if caller is None:
+        return ERROR["unauthorized"]
+
+    g.resolved = {"caller": caller}
+    for rule in rules:
+        error = rule(caller, view_args)
+        if error:
+            return error
+
+    return None
+
+def requires(*rules):
+    """
+    Route decorator for authorize(). The view gets whatever the rules
+    resolved (caller, course) that it has a parameter for.
+    """
+    def decorator(view):
+        wanted = set(inspect.signature(view).parameters)
+
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            error = authorize(rules, view_args)
+            if error:
+                return error
+
+            resolved = {name: value for name, value in g.resolved.items()
+                        if name in wanted and name not in view_args}
+            return view(**view_args, **resolved)
+
+        return wrapper
+
+    return decorator
+
+def admin(caller, view_args):
+    # 403 error
+    if caller.role != "admin":
+        return ERROR["permission"]
+
+    return None
+
+def owner(caller, view_args):
+    """
+    Only the user with the JWT matching id. 404 if there's no such user.
+    """
+    if caller.id is not None and caller.id == view_args["id"]:
+        return None
+
+    # 404 error
+    if load_user(view_args["id"]) is None:
+        return no_result()
+
+    # 403 error
+    return no_id_found()
+
+def admin_or_self(caller, view_args):
+    """
+    Admin or the user with the JWT matching id. 404 if there's no such user.
+    """
+    if caller.role == "admin" or (caller.id is not None and caller.id == view_args["id"]):
+        return None
+
+    return owner(caller, view_args)
+
+def course_exists(caller, view_args):
+    """
+    Resolves the course for id. 403 if there isn't one.
+    """
+    course = load_course(view_args["id"])
+    # 403 error
+    if course is None:
+        return no_id_found()
+
+    g.resolved["course"] = course
+    return None
+
+def admin_or_instructor_of_course(caller, view_args):
+    """
+    Admin or the instructor of course id (resolved as for course_exists).
+    """
+    error = course_exists(caller, view_args)
+    if error:
+        return error
+
+    # 403 error
+    if caller.role != "admin" and (caller.id is None or
+                                   caller.id != g.resolved["course"].get("instructor_id")):
+        return ERROR["permission"]
+
+    return None
@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a per-entry expiry.\n
+    Keeps hit/miss/eviction counters so the caches can be watched.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value for ttl seconds (the cache default if not given).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+class ByteCache:
+    """
+    Two-tier cache for blob bytes keyed by (name, generation).\n
+    An LRU in memory bounded by total bytes; entries pushed out of memory
+    spill to files under directory, which is bounded the same way. A lookup
+    with a newer generation than the cached one drops the entry.
+    """
+    def __init__(self, memory_bytes=32 * 1024 * 1024, disk_bytes=256 * 1024 * 1024,
+                 directory=None):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def get(self, name, generation):
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry is not None:
+                if entry[0] == generation:
+                    self._memory.move_to_end(name)
+                    self.memory_hits += 1
+                    return entry[1]
+                self._drop(name)
+
+            entry = self._disk.get(name)
+            if entry is not None and entry[0] != generation:
+                self._drop(name)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+        # read outside the lock so disk I/O doesn't serialize other lookups.
+        # Spills replace files atomically and unlinked files stay readable.
+        try:
+            with open(entry[1], "rb") as f:
+                data = f.read()
+        except OSError:
+            data = None
+
+        with self._lock:
+            # promote back to memory, unless it changed meanwhile
+            current = self._disk.get(name) is entry
+            if current:
+                self._drop(name)
+
+            if data is None:
+                self.misses += 1
+                return None
+
+            if current:
+                self._store(name, generation, data)
+            self.disk_hits += 1
+            return data
+
+    def set(self, name, generation, data):
+        with self._lock:
+            self._drop(name)
+            self._store(name, generation, data)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._drop(name)
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._memory) + list(self._disk):
+                self._drop(name)
+
+    def stats(self):
+        return {
+            "memory_bytes": self._memory_used,
+            "disk_bytes": self._disk_used,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions
+        }
+
+    def _store(self, name, generation, data):
+        if len(data) > self.memory_bytes:
+            return
+
+        self._memory[name] = (generation, data)
+        self._memory_used += len(data)
+
+        while self._memory_used > self.memory_bytes:
+            old_name, (old_generation, old_data) = self._memory.popitem(last=False)
+            self._memory_used -= len(old_data)
+            self.evictions += 1
+            self._spill(old_name, old_generation, old_data)
+
+    def _spill(self, name, generation, data):
+        if self.directory is None or len(data) > self.disk_bytes:
+            return
+
+        path = os.path.join(self.directory,
+                            hashlib.sha256(name.encode()).hexdigest() + f"-{generation}")
+        # write aside and rename, a reader never sees a partial file
+        try:
+            fd, temp = tempfile.mkstemp(dir=self.directory)
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            self._unlink(temp)
+            return
+
+        self._disk[name] = (generation, path, len(data))
+        self._disk_used += len(data)
+
+        while self._disk_used > self.disk_bytes:
+            _, (_, old_path, size) = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.disk_evictions += 1
+            self._unlink(old_path)
+
+    def _drop(self, name):
+        entry = self._memory.pop(name, None)
+        if entry is not None:
+            self._memory_used -= len(entry[1])
+
+        entry = self._disk.pop(name, None)
+        if entry is not None:
+            self._disk_used -= entry[2]
+            self._unlink(entry[1])
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class ResponseCache:
+    """
+    Serialized bodies for public reads, each stamped with the version of the
+    data it was built from.\n
+    Writers bump() the scopes they change; entries filled under an older
+    version miss from then on. Readers take version() before reading the
+    backend, so a write racing a fill can't leave stale data cached.
+    Bounded by maxsize entries and ttl seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.entries = LRUCache(maxsize, ttl)
+        self._versions = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def version(self, scope):
+        return self._versions.get(scope, 0)
+
+    def bump(self, *scopes):
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = next(self._counter)
+
+    def get(self, scope, key):
+        """
+        (etag, body) if there's a current entry, else None.
+        """
+        entry = self.entries.get((scope, key))
+        if entry is None or entry[0] != self.version(scope):
+            return None
+
+        return entry[1:]
+
+    def set(self, scope, key, body, version):
+        """
+        Caches body as built under version. Returns (etag, body).
+        """
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        if version == self.version(scope):
+            self.entries.set((scope, key), (version, etag, body))
+
+        return (etag, body)
@@ -0,0 +1,129 @@
+import json
+import click
+from flask import current_app
+from google.cloud import datastore
+from app import store, startup
+from app.store.cloud import BATCH_SIZE, chunks, enrollment_pairs
+
+@click.command("migrate-enrollments")
+# each row is a put and a delete, keep a batch within one commit
+@click.option("--batch-size", default=BATCH_SIZE // 2, show_default=True,
+              type=click.IntRange(1, BATCH_SIZE // 2))
+def migrate_enrollments(batch_size):
+    """
+    Rewrites auto-id enrollments under course_id:student_id keys.
+    """
+    client = store.backend.client
+    migrated = 0
+
+    while True:
+        # ids sort before names, so legacy enrollments always come first
+        query = client.query(kind="enrollments")
+        query.order = ["__key__"]
+        batch = list(query.fetch(limit=batch_size))
+
+        legacy = [e for e in batch if e.key.id is not None]
+        if not legacy:
+            break
+
+        rewritten = {}
+        for old in legacy:
+            key = store.backend.enrollment_key(old.get("course_id"), old.get("student_id"))
+            new = datastore.Entity(key=key)
+            new.update({
+                "course_id": old.get("course_id"),
+                "student_id": old.get("student_id")
+            })
+            rewritten[key] = new
+
+        with client.transaction():
+            client.put_multi(list(rewritten.values()))
+            client.delete_multi([e.key for e in legacy])
+
+        migrated += len(legacy)
+        click.echo(f"Migrated {migrated} enrollments")
+
+    click.echo(f"Done, {migrated} enrollments migrated")
+
+def expected_course_index():
+    """
+    {user_id: set of course ids} rebuilt from the courses and enrollments.
+    """
+    client = store.backend.client
+    index = {}
+
+    query = client.query(kind="courses", projection=["instructor_id"])
+    for course in query.fetch():
+        index.setdefault(course.get("instructor_id"), set()).add(course.key.id)
+
+    query = client.query(kind="enrollments")
+    query.keys_only()
+    keys = [enrollment.key for enrollment in query.fetch()]
+    for course_id, student_id in enrollment_pairs(client, keys):
+        index.setdefault(student_id, set()).add(course_id)
+
+    return index
+
+def stored_course_index():
+    client = store.backend.client
+    return {entity.key.id: set(entity.get("courses", []))
+            for entity in client.query(kind="user_courses").fetch()}
+
+@click.command("rebuild-course-index")
+def rebuild_course_index():
+    """
+    Backfills the per-user course index from courses and enrollments.
+    """
+    client = store.backend.client
+    expected = expected_course_index()
+    stored = stored_course_index()
+
+    updated = []
+    for user_id, courses in expected.items():
+        if stored.get(user_id) != courses:
+            entity = datastore.Entity(key=store.backend.index_key(user_id),
+                                      exclude_from_indexes=("courses",))
+            entity["courses"] = sorted(courses)
+            updated.append(entity)
+
+    for chunk in chunks(updated):
+        client.put_multi(chunk)
+
+    stale = [store.backend.index_key(user_id) for user_id in stored if user_id not in expected]
+    for chunk in chunks(stale):
+        client.delete_multi(chunk)
+
+    click.echo(f"Rewrote {len(updated)} course index entries, removed {len(stale)}")
+
+@click.command("check-course-index")
+def check_course_index():
+    """
+    Reports users whose course index doesn't match their courses/enrollments.
+    """
+    expected = expected_course_index()
+    stored = stored_course_index()
+
+    mismatched = 0
+    for user_id in sorted(set(expected) | set(stored), key=str):
+        want = expected.get(user_id, set())
+        have = stored.get(user_id, set())
+        if want != have:
+            mismatched += 1
+            click.echo(f"user {user_id}: missing {sorted(want - have)}, "
+                       f"extra {sorted(have - want)}")
+
+    click.echo(f"{mismatched} inconsistent course index entries")
+    if mismatched:
+        raise SystemExit(1)
+
+@click.command("startup-report")
+@click.option("--warm/--no-warm", default=True, show_default=True)
+def startup_report(warm):
+    """
+    Prints where startup time went: imports, create_app and, with --warm,
+    the /_ah/warmup steps.
+    """
+    if warm:
+        current_app.test_client().get("/_ah/warmup")
+
+    click.echo(json.dumps(startup.report(), indent=2))
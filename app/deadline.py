@@ -0,0 +1,195 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import requests
+from flask import g, has_request_context, request
+from google.api_core.exceptions import DeadlineExceeded as CallTimedOut, RetryError
+from google.api_core.retry import Retry, if_transient_error
+
+# seconds, for endpoints that need more than REQUEST_DEADLINE. Bodies
+# streamed with stream_with_context (the bulk imports) stay on the budget.
+DEADLINES = {
+    "users.create_avatar": 30,
+    "bulk.import_courses": 300,
+    "bulk.import_enrollments": 300
+}
+
+# what the Cloud clients raise when a call runs out of time
+TIMEOUT_ERRORS = (CallTimedOut, RetryError, requests.Timeout)
+
+# samples per call kept for the hedging delay, and how many before hedging
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+class DeadlineExceeded(Exception):
+    """
+    The request's budget ran out before a backend call could finish (503).
+    """
+
+class Deadline:
+    """
+    Per-request time budgets for Datastore and Cloud Storage calls.\n
+    Each request gets DEADLINES[endpoint] (or REQUEST_DEADLINE) seconds
+    from when it starts. Backend calls take their timeout, and for reads a
+    retry policy, from what's left via options(), and raise
+    DeadlineExceeded once nothing is.\n
+    With HEDGE_READS on, hedged() reads send a second identical request if
+    the first hasn't answered within that call's recent p95, and use
+    whichever answers first.
+    """
+    def __init__(self):
+        self.default = 10
+        self.deadlines = dict(DEADLINES)
+        self.min_delay = 0.005
+        self._executor = None
+        self._workers = None
+        self._samples = {}
+        self._seen = {}
+        self._delays = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(["exceeded", "hedged", "hedge_won"], 0)
+
+    def init_app(self, app):
+        self.default = app.config.get('REQUEST_DEADLINE', self.default)
+        self.deadlines.update(app.config.get('DEADLINES', {}))
+        self.min_delay = app.config.get('HEDGE_MIN_DELAY_MS', 5) / 1000
+        if app.config.get('HEDGE_READS'):
+            workers = app.config.get('HEDGE_WORKERS', 16)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+            self._workers = threading.BoundedSemaphore(workers)
+
+        app.before_request(self._start)
+
+    def remaining(self):
+        """
+        Seconds left in this request's budget, None outside a request.
+        """
+        if not has_request_context():
+            return None
+
+        expires = g.get("_deadline")
+        if expires is None:
+            return None
+
+        return expires - time.monotonic()
+
+    def timeout(self, cap=None):
+        """
+        What's left of the budget, at most cap (cap outside a request).
+        Raises DeadlineExceeded if nothing is.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+
+        if remaining <= 0:
+            raise DeadlineExceeded()
+
+        return remaining if cap is None else min(remaining, cap)
+
+    def options(self, read=False, cap=None):
+        """
+        timeout (and for reads a transient-error retry) kwargs for a Cloud
+        client call, bounded by the budget. {} means the client's defaults.
+        """
+        timeout = self.timeout(cap)
+        if timeout is None:
+            return {}
+
+        options = {"timeout": timeout}
+        if read:
+            options["retry"] = Retry(predicate=if_transient_error, initial=0.05,
+                                     maximum=1.0, timeout=timeout)
+
+        return options
+
+    def hedged(self, name, call):
+        """
+        Returns call(). With hedging on and enough samples of name, a second
+        call() goes out if the first is slower than their p95. Only for
+        idempotent reads.\n
+        Calls only go to the pool when a worker is free, they never queue:
+        under load the read runs on the calling thread, unhedged.
+        """
+        if self._executor is None:
+            return call()
+
+        delay = self._delays.get(name)
+        if delay is None or not self._workers.acquire(blocking=False):
+            return self._observe(name, call)
+
+        primary = self._submit(name, call)
+        if wait([primary], timeout=delay).done:
+            return primary.result()
+
+        pending = [primary]
+        backup = None
+        if self._workers.acquire(blocking=False):
+            self._count("hedged")
+            backup = self._submit(name, call)
+            pending.append(backup)
+
+        while pending:
+            done, pending = wait(pending, timeout=self.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded()
+
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self._count("hedge_won")
+                    return future.result()
+
+        # both failed
+        return primary.result()
+
+    def exceeded(self):
+        """
+        Counts a request that ran out of budget.
+        """
+        self._count("exceeded")
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _observe(self, name, call):
+        start = time.perf_counter()
+        result = call()
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=HEDGE_WINDOW)
+            samples.append(elapsed)
+            seen = self._seen[name] = self._seen.get(name, 0) + 1
+
+            # refresh the p95 every so often, not on every call
+            if seen % HEDGE_MIN_SAMPLES == 0:
+                ordered = sorted(samples)
+                self._delays[name] = max(ordered[int(len(ordered) * 0.95) - 1], self.min_delay)
+
+        return result
+
+    def _submit(self, name, call):
+        """
+        Runs call on a worker already reserved from _workers.
+        """
+        def run():
+            try:
+                return self._observe(name, call)
+            finally:
+                self._workers.release()
+
+        return self._executor.submit(contextvars.copy_context().run, run)
+
+    def _start(self):
+        budget = self.deadlines.get(request.endpoint, self.default)
+        g._deadline = time.monotonic() + budget
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
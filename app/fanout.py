@@ -0,0 +1,31 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+class FanOut:
+    """
+    Runs independent blocking lookups at the same time.\n
+    gather() keeps the first call on the calling thread and hands the rest
+    to a shared pool, each with a copy of the caller's context so flask.g,
+    request and the metrics hooks still work there.
+    """
+    def __init__(self):
+        self._executor = None
+
+    def init_app(self, app):
+        workers = app.config.get('FANOUT_WORKERS', 32)
+        if workers:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+
+    def gather(self, *calls):
+        """
+        Calls each zero-argument callable and returns their results in order.
+        """
+        if self._executor is None or len(calls) < 2:
+            return [call() for call in calls]
+
+        futures = [self._executor.submit(contextvars.copy_context().run, call)
+                   for call in calls[1:]]
+
+        results = [calls[0]()]
+        results.extend(future.result() for future in futures)
+        return results
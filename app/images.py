@@ -0,0 +1,105 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+
+# magic bytes of the formats we accept
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif")
+]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class ImageError(Exception):
+    pass
+
+def sniff(data):
+    """
+    The image format from the leading bytes, or None if it isn't one we take.
+    """
+    for signature, kind in SIGNATURES:
+        if data.startswith(signature):
+            return kind
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+
+    return None
+
+def read_limited(stream, limit, chunk_size=64 * 1024):
+    """
+    Reads stream in chunks, giving up as soon as it passes limit bytes.
+    Returns the bytes, or None if the stream was too big.
+    """
+    buffer = io.BytesIO()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return buffer.getvalue()
+        if buffer.tell() + len(chunk) > limit:
+            return None
+        buffer.write(chunk)
+
+def render_variants(data, sizes):
+    """
+    Decodes data and re-encodes it as normalized PNGs: {None: original,
+    size: fit in size x size}. Runs in the image process pool.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+    except Exception as e:
+        raise ImageError(str(e))
+
+    variants = {None: _encode(image)}
+    for size in sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        variants[size] = _encode(thumbnail)
+
+    return variants
+
+def process(data, sizes, workers=2):
+    """
+    Renders the variants in the process pool so the resize doesn't hold the
+    GIL on the request thread. Returns {size: png bytes}.
+    """
+    pool = _get_pool(workers)
+    try:
+        return pool.submit(render_variants, data, tuple(sizes)).result()
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM on a huge image), start a fresh pool next time
+        _reset_pool(pool)
+        raise ImageError("image worker crashed")
+
+def _encode(image):
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+def _get_pool(workers):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn - forking a process with live gRPC threads can deadlock
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+
+    return _pool
+
+def _reset_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,126 @@
+import json
+import re
+import threading
+import time
+from jose import jwk
+from six.moves.urllib.request import urlopen
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+class JWKSStore:
+    """
+    In-process cache of the Auth0 signing keys, indexed by kid.\n
+    Keys are parsed once per fetch and kept until the endpoint's
+    Cache-Control max-age (or JWKS_TTL) runs out. If a refresh fails the
+    old keys keep being served, so a slow IdP doesn't take auth down.
+    """
+    def __init__(self):
+        self.url = None
+        self.ttl = 600
+        self.min_refresh = 30
+        self.timeout = 5
+        self._keys = {}
+        self._expires = 0
+        self._last_fetch = 0
+        self._last_done = 0
+        self._lock = threading.Lock()
+        self._rotate_callbacks = []
+        self.record = None
+
+    def init_app(self, app):
+        domain = app.config.get('DOMAIN')
+        self.url = f"https://{domain}/.well-known/jwks.json" if domain else None
+        self.ttl = app.config.get('JWKS_TTL', self.ttl)
+        self.min_refresh = app.config.get('JWKS_MIN_REFRESH', self.min_refresh)
+        self.timeout = app.config.get('JWKS_TIMEOUT', self.timeout)
+
+    def on_rotate(self, callback):
+        """
+        Registers callback to run when a previously served key is retired.
+        """
+        if callback not in self._rotate_callbacks:
+            self._rotate_callbacks.append(callback)
+
+    def get_key(self, kid):
+        """
+        Returns the parsed key for kid, or None if the IdP doesn't know it.
+        """
+        if time.monotonic() >= self._expires:
+            self.refresh()
+
+        key = self._keys.get(kid)
+
+        # unknown kid - keys may have rotated, refetch (rate limited)
+        if key is None and kid is not None:
+            if time.monotonic() - self._last_fetch >= self.min_refresh:
+                self.refresh()
+                key = self._keys.get(kid)
+
+        return key
+
+    def warm(self):
+        """
+        Fetches the key set ahead of the first token. Raises if there isn't one.
+        """
+        self.get_key(None)
+        if not self._keys:
+            raise LookupError(f"no signing keys from {self.url}")
+
+    def refresh(self):
+        # with keys on hand, let one thread refetch while others use them
+        asked = time.monotonic()
+        if not self._lock.acquire(blocking=not self._keys):
+            return
+
+        try:
+            # another thread fetched (or failed to) while we waited, keys or not
+            if self._last_done >= asked:
+                return
+
+            self._last_fetch = time.monotonic()
+            start = time.perf_counter()
+            try:
+                response = urlopen(self.url, timeout=self.timeout)
+                jwks = json.loads(response.read())
+                ttl = self._max_age(response.headers.get("Cache-Control"))
+            except Exception:
+                # keep serving stale keys, retry after min_refresh
+                self._expires = self._last_fetch + self.min_refresh
+                return
+            finally:
+                self._last_done = time.monotonic()
+                if self.record is not None:
+                    self.record("jwks", time.perf_counter() - start)
+
+            self.load(jwks, ttl)
+        finally:
+            self._lock.release()
+
+    def load(self, jwks, ttl=None):
+        """
+        Replaces the key set with the keys in a JWKS document.
+        """
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            try:
+                keys[key["kid"]] = jwk.construct(key, key.get("alg", "RS256"))
+            except Exception:
+                continue
+
+        retired = set(self._keys) - set(keys)
+        self._keys = keys
+        self._expires = time.monotonic() + (ttl if ttl is not None else self.ttl)
+
+        if retired:
+            for callback in self._rotate_callbacks:
+                callback()
+
+    def _max_age(self, cache_control):
+        if cache_control:
+            match = MAX_AGE.search(cache_control)
+            if match:
+                return max(int(match.group(1)), self.min_refresh)
+
+        return None
@@ -0,0 +1,146 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram, one series per label tuple.
+    """
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        # counts per bucket, the last slot is +Inf
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for labels, (counts, total, count) in series:
+            base = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.labels, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+
+        return lines
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """
+    Per-request timing of outbound calls (JWKS, Datastore, GCS, Auth0).\n
+    Components report with record(name, seconds). While a request is
+    running the time is added to that request's breakdown, which goes out
+    as a Server-Timing header and into the histograms behind /metrics,
+    labeled by route. Calls made outside a request (background tasks,
+    startup) aren't counted.
+    """
+    def __init__(self):
+        self.requests = Histogram("tarpaulin_request_duration_seconds",
+                                  "Request latency by route.", ("route", "method", "status"))
+        self.calls = Histogram("tarpaulin_call_duration_seconds",
+                               "Time a request spent in each kind of outbound call.",
+                               ("route", "call"))
+        self._counters = {}
+        # fanned-out lookups report from several threads
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def add_counters(self, name, collect, gauges=()):
+        """
+        Exports collect()'s {event: count} as tarpaulin_<name>_total{event=...}.
+        Keys in gauges (sizes, bytes) go out as tarpaulin_<name>{stat=...}.
+        One collector per name, registering it again replaces it.
+        """
+        self._counters[name] = (collect, frozenset(gauges))
+
+    def record(self, name, seconds):
+        if not has_request_context():
+            return
+
+        timings = g.get("_timings")
+        if timings is None:
+            return
+
+        with self._lock:
+            count, total = timings.get(name, (0, 0.0))
+            timings[name] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def render(self):
+        """
+        Everything in the Prometheus text exposition format.
+        """
+        lines = self.requests.render() + self.calls.render()
+        for name, (collect, gauges) in list(self._counters.items()):
+            values = sorted(collect().items())
+            counts = [(event, count) for event, count in values if event not in gauges]
+            if counts or not gauges:
+                lines += [f"# TYPE tarpaulin_{name}_total counter"]
+                lines += [f'tarpaulin_{name}_total{{event="{escape(event)}"}} {count}'
+                          for event, count in counts]
+            if gauges:
+                lines += [f"# TYPE tarpaulin_{name} gauge"]
+                lines += [f'tarpaulin_{name}{{stat="{escape(stat)}"}} {value}'
+                          for stat, value in values if stat in gauges]
+
+        return "\n".join(lines) + "\n"
+
+    def _start(self):
+        g._timings = {}
+        g._request_start = time.perf_counter()
+
+    def _finish(self, response):
+        start = g.get("_request_start")
+        if start is None:
+            return response
+
+        elapsed = time.perf_counter() - start
+        timings = g._timings
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+        parts = [f'{name};dur={total * 1000:.1f};desc="{count} calls"'
+                 for name, (count, total) in timings.items()]
+        parts.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(parts)
+
+        self.requests.observe((route, request.method, str(response.status_code)), elapsed)
+        for name, (count, total) in timings.items():
+            self.calls.observe((route, name), total)
+
+        return response
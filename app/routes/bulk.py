@@ -0,0 +1,216 @@
+import json
+from flask import Blueprint, Response, request, stream_with_context
+from app import store, course_cache, deadline
+from app.deadline import DeadlineExceeded
+from app.store import COURSE_FIELDS
+from app.authz import requires, admin
+from app.utility import *
+
+bp = Blueprint('bulk', __name__, url_prefix='/bulk')
+
+NDJSON = "application/x-ndjson"
+
+# rows validated and written together, and rows per exported page
+BULK_BATCH = 500
+
+ENCODER = json.JSONEncoder(separators=(",", ":"), sort_keys=True)
+
+@bp.route('/courses', methods=['POST'])
+@requires(admin)
+def import_courses():
+    """
+    Create courses from an NDJSON body, one course per line.\n
+    Instructors are checked and courses written a batch at a time. The
+    response streams one NDJSON result per line: {"line", "status"} plus
+    the course's "id" and "self" (201) or an "Error" (400, or 503 for the
+    lines left once the time budget runs out).\n
+    Protection: Admin only
+    """
+    host_url = request.host_url
+
+    def results():
+        return batch_results(read_batches(request.stream),
+                             lambda batch: import_course_batch(batch, host_url))
+
+    return Response(stream_with_context(results()), 200, mimetype=NDJSON)
+
+@bp.route('/courses', methods=['GET'])
+@requires(admin)
+def export_courses():
+    """
+    Stream every course as NDJSON, paged through the store by cursor.\n
+    Protection: Admin only
+    """
+    def rows():
+        for courses in pages(store.courses.page):
+            yield encode(courses)
+
+    return Response(rows(), 200, mimetype=NDJSON)
+
+@bp.route('/enrollments', methods=['POST'])
+@requires(admin)
+def import_enrollments():
+    """
+    Enroll students from an NDJSON body of {"course_id", "student_id"}
+    lines.\n
+    Courses and students are checked and enrollments written a batch at
+    a time. The response streams one NDJSON result per line: {"line",
+    "status"} with 200, or an "Error" (400 malformed, 409 no such course
+    or not a student, 503 out of time).\n
+    Protection: Admin only
+    """
+    def results():
+        return batch_results(read_batches(request.stream), import_enrollment_batch)
+
+    return Response(stream_with_context(results()), 200, mimetype=NDJSON)
+
+@bp.route('/enrollments', methods=['GET'])
+@requires(admin)
+def export_enrollments():
+    """
+    Stream every enrollment as {"course_id", "student_id"} NDJSON, paged
+    through the store by cursor.\n
+    Protection: Admin only
+    """
+    def rows():
+        for pairs in pages(store.enrollments.page):
+            yield encode({"course_id": course_id, "student_id": student_id}
+                         for course_id, student_id in pairs)
+
+    return Response(rows(), 200, mimetype=NDJSON)
+
+def read_batches(stream):
+    """
+    Yields lists of (line number, parsed row or None) of up to BULK_BATCH,
+    None for lines that aren't a JSON object. Blank lines are skipped.
+    """
+    batch = []
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+
+        batch.append((number, row if isinstance(row, dict) else None))
+        if len(batch) == BULK_BATCH:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def batch_results(batches, apply):
+    """
+    Yields the encoded apply(batch) results for each batch. The budget keeps
+    running while the body streams: once a batch runs out of it, that batch
+    and every later line get a 503 result instead, so the response still
+    accounts for every line.
+    """
+    expired = False
+    for batch in batches:
+        rows = None
+        if not expired:
+            try:
+                rows = apply(batch)
+            except DeadlineExceeded:
+                deadline.exceeded()
+                expired = True
+
+        # 503 error - out of time, the line may not have been applied
+        if rows is None:
+            rows = [result(number, out_of_time()) for number, _ in batch]
+
+        yield encode(rows)
+
+def import_course_batch(batch, host_url):
+    results = {}
+    rows = []
+    for number, row in batch:
+        # 400 error
+        if row is None or attribute_check(COURSE_FIELDS, row):
+            results[number] = result(number, missing())
+        else:
+            rows.append((number, row))
+
+    # one lookup for every instructor in the batch
+    instructors = load_users({row["instructor_id"] for _, row in rows
+                                         if is_id(row["instructor_id"])})
+
+    valid = []
+    for number, row in rows:
+        instructor = instructors.get(row["instructor_id"]) if is_id(row["instructor_id"]) else None
+        # 400 error
+        if instructor is None or instructor.get("role") != "instructor":
+            results[number] = result(number, missing())
+        else:
+            valid.append((number, row))
+
+    if valid:
+        created = store.courses.create_many([row for _, row in valid])
+        course_cache.bump("catalog")
+
+        for (number, _), course in zip(valid, created):
+            results[number] = {
+                "line": number,
+                "status": 201,
+                "id": course["id"],
+                "self": f"{host_url}courses/{course['id']}"
+            }
+
+    return [results[number] for number, _ in batch]
+
+def import_enrollment_batch(batch):
+    results = {}
+    rows = []
+    for number, row in batch:
+        # 400 error
+        if (row is None or attribute_check(["course_id", "student_id"], row)
+                or not is_id(row["course_id"]) or not is_id(row["student_id"])):
+            results[number] = result(number, missing())
+        else:
+            rows.append((number, row))
+
+    # one lookup each for the batch's courses and students
+    courses = store.courses.get_multi({row["course_id"] for _, row in rows})
+    students = load_users({row["student_id"] for _, row in rows})
+
+    pairs = []
+    for number, row in rows:
+        student = students.get(row["student_id"])
+        # 409 error
+        if (row["course_id"] not in courses or student is None
+                or student.get("role") != "student"):
+            results[number] = result(number, enrollment_invalid())
+        else:
+            pairs.append((row["course_id"], row["student_id"]))
+            results[number] = {"line": number, "status": 200}
+
+    if pairs:
+        store.enrollments.add_many(pairs)
+
+    return [results[number] for number, _ in batch]
+
+def pages(page):
+    """
+    Yields page(BULK_BATCH, cursor)'s rows until there's no next cursor.
+    """
+    cursor = None
+    while True:
+        rows, cursor = page(BULK_BATCH, cursor)
+        if rows:
+            yield rows
+        if cursor is None:
+            return
+
+def result(number, error):
+    body, status = error
+    return {"line": number, "status": status, **body}
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def encode(rows):
+    return "".join(ENCODER.encode(row) + "\n" for row in rows)
@@ -1,10 +1,20 @@
-from flask import Blueprint, request, jsonify
-from google.cloud import datastore
+from urllib.parse import quote
+from flask import Blueprint, request, jsonify, current_app
+from app import store, tasks, course_cache
+from app.store import InvalidCursor, UnsupportedQuery, course_sort
+from app.authz import requires, admin, course_exists, admin_or_instructor_of_course
 from app.utility import *
 
 bp = Blueprint('courses', __name__, url_prefix='/courses')
 
+# equality filters get_courses takes and how to parse them
+FILTERS = {"term": str, "subject": str, "instructor_id": int}
+
+# everything that shapes a listing, carried over into the next url
+QUERY_ARGS = ["term", "subject", "instructor_id", "number_min", "number_max", "sort"]
+
 @bp.route('', methods=['POST'])
+@requires(admin)
 def create_course():
     """
     Create a course.\n
@@ -12,16 +22,6 @@ def create_course():
     """
     data = request.get_json()
 
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    # 403 error
-    else:
-        permission_error = permission(sub[0])
-        if permission_error:
-            return permission_error
-    
     # 400 error
     required_attributes = ["subject", "number", "title", "term", "instructor_id"]
     validation_error = attribute_check(required_attributes, data)
@@ -33,22 +33,15 @@ def create_course():
         return role_error
     
     # create new course
-    new_course = datastore.Entity(key=client.key("courses"))
-    new_course.update({
-        "subject": data["subject"],
-        "number": data["number"],
-        "title": data["title"],
-        "term": data["term"],
-        "instructor_id": data["instructor_id"]
-    })
-    client.put(new_course)
+    new_course = store.courses.create(data)
+    course_cache.bump("catalog")
 
     # generate self url
-    course_url = f"{request.host_url}courses/{new_course.key.id}"
+    course_url = f"{request.host_url}courses/{new_course['id']}"
 
     # 201 response
     return jsonify({
-        "id": new_course.key.id,
+        "id": new_course["id"],
         "subject": data["subject"],
         "number": data["number"],
         "title": data["title"],
@@ -60,50 +53,89 @@ def create_course():
 @bp.route('', methods=['GET'])
 def get_courses():
     """
-    Get all courses. Paginated using offset/limit. Doesn't return info on 
-    course enrollment.\n
+    Get all courses. Paginated using an opaque cursor/limit (offset/limit 
+    still works for older clients). Doesn't return info on course 
+    enrollment. Pages are cached until a course changes.\n
+    Cursor pages can be filtered by term, subject, instructor_id and a
+    number_min/number_max range, and ordered with sort (e.g. sort=-number).
+    Combinations without a Datastore index (COURSE_QUERIES) are a 400.\n
     Protection: Unprotected
     """
     # extract pagination data
-    offset = int(request.args.get("offset", 0))
-    limit = int(request.args.get("limit", 3))
+    cursor = request.args.get("cursor")
+    offset = request.args.get("offset")
+    try:
+        limit = int(request.args.get("limit", 3))
+        offset = int(offset) if offset is not None else None
+    except ValueError:
+        return missing()
+
+    # 400 error
+    if not 0 < limit <= GET_LIMIT or (offset is not None and offset < 0):
+        return missing()
+
+    listing = [(name, request.args[name]) for name in QUERY_ARGS if name in request.args]
+
+    # 400 error - malformed filters, or filters no index serves
+    try:
+        filters, number, sort = course_query(request.args)
+    except ValueError:
+        return missing()
+    except UnsupportedQuery:
+        return unsupported_query()
+
+    if listing and offset is not None and cursor is None:
+        return unsupported_query()
+
+    # links are written against CACHED_HOST_URL, so the key leaves the host
+    # out and a page primed by /_ah/warmup serves whatever Host asks
+    page_key = (limit, cursor, offset, tuple(listing))
+    cached = course_cache.get("catalog", page_key)
+    if cached is not None:
+        return cached_json(cached)
+
+    version = course_cache.version("catalog")
 
     # query courses
-    query = client.query(kind="courses")
-    query.order = ["subject"]
-    courses_result = query.fetch(offset=offset, limit=limit)
+    next_url = None
+    if offset is not None and cursor is None:
+        courses_result, more = store.courses.page_offset(offset, limit)
+        if more:
+            next_url = f"{CACHED_HOST_URL}courses?offset={offset + limit}&limit={limit}"
+    else:
+        try:
+            courses_result, next_cursor = store.courses.page(limit, cursor, filters, sort, number)
+        # 400 error - bad cursor
+        except InvalidCursor:
+            return missing()
+
+        if next_cursor:
+            params = "".join(f"&{name}={quote(value, safe='')}" for name, value in listing)
+            next_url = f"{CACHED_HOST_URL}courses?cursor={quote(next_cursor)}&limit={limit}{params}"
 
     # generate result
     courses =[]
     for course in courses_result:
         course_data = {
-            "id": course.key.id,
+            "id": course["id"],
             "instructor_id": course["instructor_id"],
             "number": course["number"],
             "subject": course["subject"],
             "term": course["term"],
             "title": course["title"],
-            "self": f"{request.host_url}courses/{course.key.id}"
+            "self": f"{CACHED_HOST_URL}courses/{course['id']}"
         }
         courses.append(course_data)
 
     response = {
         "courses": courses
     }
-
-    # determine pagination limits
-    query = client.query(kind="courses")
-    total_count = len(list(query.fetch()))
-    next_offset = offset + limit
-    next_url = None
-    if next_offset < total_count:
-        next_url = f"{request.host_url}courses?offset={next_offset}&limit={limit}"
     
     # create response
     if next_url:
         response.update({"next": next_url})
     
-    return jsonify(response), 200
+    return cached_json(course_cache.set("catalog", page_key, json_body(response), version))
 
 @bp.route('/<int:id>', methods=['GET'])
 def get_course(id):
@@ -111,48 +143,39 @@ def get_course(id):
     Gets a course based on id. Doesn't return info on course enrollment.\n
     Protection: Unprotected
     """
-    course = client.get(key=client.key("courses", id))
+    scope = f"course:{id}"
+    cached = course_cache.get(scope, "course")
+    if cached is not None:
+        return cached_json(cached)
+
+    version = course_cache.version(scope)
+    course = load_course(id)
 
     # 404 error
     if course is None:
         return no_result()
     
     response = {
-        "id": course.key.id,
+        "id": course["id"],
         "instructor_id": course.get("instructor_id"),
         "number": course.get("number"),
         "subject": course.get("subject"),
         "term": course.get("term"),
         "title": course.get("title"),
-        "self": f"{request.host_url}courses/{course.key.id}"
+        "self": f"{CACHED_HOST_URL}courses/{course['id']}"
     }
 
-    return (jsonify(response), 200)
+    return cached_json(course_cache.set(scope, "course", json_body(response), version))
 
 @bp.route('/<int:id>', methods=['PATCH'])
-def update_course(id):
+@requires(admin, course_exists)
+def update_course(id, course):
     """
     Partially updates a course.\n
     Protection: Admin only
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    # 403 error
-    else:
-        permission_error = permission(sub[0])
-        if permission_error:
-            return permission_error
-
     data = request.get_json()
 
-    course = client.get(key=client.key("courses", id))
-
-    # 403 error
-    if course is None:
-        return no_id_found()
-    
     # 400 error
     if "instructor_id" in data:
         user_error = invalid_user(data["instructor_id"])
@@ -160,88 +183,56 @@ def update_course(id):
             return user_error
     
     # update fields
-    updatable_fields = ["subject", "number", "title", "term", "instructor_id"]
-    for field in updatable_fields:
-        if field in data:
-            course.update({f"{field}": data[f"{field}"]})
-    
-    client.put(course)
+    course = store.courses.update(course, data)
+    remember("courses", id, course)
+    course_cache.bump("catalog", f"course:{id}")
 
     response = {
-        "id": course.key.id,
+        "id": course["id"],
         "instructor_id": course.get("instructor_id"),
         "number": course.get("number"),
         "subject": course.get("subject"),
         "term": course.get("term"),
         "title": course.get("title"),
-        "self": f"{request.host_url}courses/{course.key.id}"
+        "self": f"{request.host_url}courses/{course['id']}"
     }
 
     return (jsonify(response), 200)
 
 @bp.route('/<int:id>', methods=['DELETE'])
-def delete_course(id):
+@requires(admin, course_exists)
+def delete_course(id, course):
     """
     Deletes a course and enrollment info.\n
     Protection: Admin only
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    # 403 error
-    else:
-        permission_error = permission(sub[0])
-        if permission_error:
-            return permission_error
-    
-    course_key = client.key("courses", id)
-    course = client.get(key=course_key)
+    store.courses.delete(course)
+    remember("courses", id, None)
+    course_cache.bump("catalog", f"course:{id}")
 
-    if course is None:
-        return no_id_found()
-    
-    client.delete(course_key)
+    student_ids = store.enrollments.students(id)
 
-    query = client.query(kind="enrollments")
-    query.add_filter("course_id", "=", id)
-    results = list(query.fetch())
-    for result in results:
-        enrollment_key = client.key("enrollments", result.key.id)
-        client.delete(enrollment_key)
+    # big rosters finish in the background
+    if len(student_ids) > current_app.config['CASCADE_INLINE_LIMIT']:
+        tasks.submit(store.enrollments.remove_all, id, student_ids)
+        return (jsonify({
+            "enrollments": len(student_ids),
+            "status": "pending"
+        }), 202)
 
-    return ("", 204)
+    deleted = store.enrollments.remove_all(id, student_ids)
+
+    return ("", 204, {"X-Enrollments-Deleted": str(deleted)})
 
 
 @bp.route('/<int:id>/students', methods=['PATCH'])
+@requires(admin_or_instructor_of_course)
 def update_enrollment(id):
     """
-    Enroll and/or disenroll students from a course.\n
+    Enroll and/or disenroll students from a course. Large rosters commit in
+    chunks; if the request fails partway, sending it again finishes it.\n
     Protection: Admin or instructor of course
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-
-    sub = sub[0]
-    
-    course_key = client.key("courses", id)
-    course = client.get(key=course_key)
-
-    if course is None:
-        return no_id_found()
-
-    # 403 error
-    instructor_id = course.get("instructor_id")
-
-    query = client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    results = list(query.fetch())
-    for result in results:
-        if result.get("role") != "admin" and result.key.id != instructor_id:
-            return no_id_found()
-
     data = request.get_json()
 
     required_attributes = ["add", "remove"]
@@ -254,81 +245,42 @@ def update_enrollment(id):
     add = data["add"]
     remove = data["remove"]
 
-    for user_id in add:
-        # 409 error - i
-        if user_id in remove:
-            return enrollment_invalid()
-        
-        user = client.get(key=client.key("users", user_id))
+    # 409 error - i
+    if set(add) & set(remove):
+        return enrollment_invalid()
 
-        # 409 error - ii
+    # 409 error - ii
+    student_ids = set(add) | set(remove)
+    students = load_users(student_ids)
+    for user_id in student_ids:
+        user = students.get(user_id)
         if user is None or user.get("role") != "student":
             return enrollment_invalid()
-        
-        enrollment_key = client.key("enrollments", user_id)
-        enrollment = client.get(key=enrollment_key)
-
-        # don't add if already there
-        if enrollment is None:
-            new_enrollment = datastore.Entity(key=client.key("enrollments"))
-            new_enrollment.update({
-                "course_id": id,
-                "student_id": user_id
-            })
-            client.put(new_enrollment)
-    
-    for user_id in remove:
-        user = client.get(key=client.key("users", user_id))
 
-        # 409 error - ii
-        if user is None or user.get("role") != "student":
-            return enrollment_invalid()
-        
-        query = client.query(kind="enrollments")
-        query.add_filter("student_id", "=", user_id)
-        results = list(query.fetch())
-        for result in results:
-            enrollment_key = client.key("enrollments", result.key.id)
-            client.delete(enrollment_key)
+    # applied in idempotent chunks, a failed update is finished by retrying it
+    store.enrollments.update(id, add, remove)
         
     return ("", 200)
 
 @bp.route('/<int:id>/students', methods=['GET'])
+@requires(admin_or_instructor_of_course)
 def get_enrollments(id):
     """
     Get the list of students enrolled in a course.
     Protection: Admin or instructor of course
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-
-    sub = sub[0]
+    response = store.enrollments.students(id)
     
-    course_key = client.key("courses", id)
-    course = client.get(key=course_key)
-
-    if course is None:
-        return no_id_found()
+    return jsonify(response), 200
 
-    # 403 error
-    instructor_id = course.get("instructor_id")
+def course_query(args):
+    """
+    (filters, number range, sort) for get_courses' query string. Raises
+    ValueError for malformed values and UnsupportedQuery for combinations
+    without an index.
+    """
+    filters = {name: parse(args[name]) for name, parse in FILTERS.items() if name in args}
+    number = tuple(int(args[name]) if name in args else None
+                   for name in ("number_min", "number_max"))
 
-    query = client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    results = list(query.fetch())
-    for result in results:
-        if result.get("role") != "admin" and result.key.id != instructor_id:
-            return no_id_found()
-    
-    response = []
-
-    e_query = client.query(kind="enrollments")
-    e_query.add_filter("course_id", "=", course.key.id)
-    results = list(e_query.fetch())
-    for student in results:
-        student_id = student.get("student_id")
-        response.append(student_id)
-    
-    return jsonify(response), 200
+    return (filters, number, course_sort(filters, args.get("sort"), number != (None, None)))
@@ -0,0 +1,12 @@
+from flask import Blueprint, Response
+from app import metrics
+
+bp = Blueprint('monitoring', __name__)
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Request and outbound call latency histograms, Prometheus text format.\n
+    Protection: Unprotected
+    """
+    return Response(metrics.render(), 200, mimetype='text/plain; version=0.0.4')
@@ -1,10 +1,23 @@
-import requests
-import io
-from flask import Blueprint, request, jsonify, current_app, send_file
-from google.cloud import storage
+import json
+from urllib.parse import quote
+from werkzeug.exceptions import RequestEntityTooLarge
+from flask import Blueprint, Response, request, jsonify, current_app, redirect
+from app import store, images, fanout, broker
+from app.auth0 import Auth0Error, Auth0Unavailable, LoginRejected
+from app.store import InvalidCursor
+from app.authz import requires, authorize, current_caller, admin, owner, admin_or_self
 from app.utility import *
 
-AVATAR_BUCKET = "cs-tarpaulin"
+# room for the multipart framing around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+ROLES = ("admin", "instructor", "student")
+
+# users per chunk written to a streamed listing
+STREAM_BATCH = 200
+
+# built once, json.dumps with options makes a new encoder per call
+ENCODER = json.JSONEncoder(separators=(",", ":"), sort_keys=True)
 
 bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -24,58 +37,148 @@ def login():
     username = content["username"]
     password = content["password"]
 
-    body = {
-        'grant_type':'password',
-        'username': username,
-        'password': password,
-        'client_id': current_app.config['CLIENT_ID'],
-        'client_secret': current_app.config['CLIENT_SECRET']
-    }
-    headers = { 'content-type': 'application/json' }
-    url = 'https://' + current_app.config['DOMAIN'] + '/oauth/token'
-
-    req = requests.post(url, json=body, headers=headers)
-
-    if req.status_code == 200:
-        token = req.json().get('id_token')
-        if token:
-            return jsonify({"token": token}), 200
-        # error (not required)
-    elif req.status_code == 403:
+    try:
+        token = broker.password_grant(username, password)
+    # 401 error
+    except LoginRejected:
         return user_pass_check()
-    else:
-        # error (not required)
-        return
+    # 503 error - Auth0 is degraded, failing fast
+    except Auth0Unavailable:
+        return upstream_unavailable()
+    # 502 error
+    except Auth0Error:
+        return upstream_error()
+
+    return jsonify({"token": token}), 200
 
 @bp.route('', methods=['GET'])
+@requires(admin)
 def get_users():
     """
     Summary of all users. No info about avatar or courses.\n
+    ?role= filters by role. ?limit= (and ?cursor=) returns one page as
+    {"users", "next"}. Otherwise the whole list streams, as a JSON array or
+    as NDJSON with ?format=ndjson / Accept: application/x-ndjson.\n
+    ?ids=1,2,3 looks up just those users (add &avatar=true for avatar_url).\n
     Protection: Admin only
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    # 403 error
-    else:
-        permission_error = permission(sub[0])
-        if permission_error:
-            return permission_error
-    
-    query = client.query(kind="users")
-    results = list(query.fetch())
+    if "ids" in request.args:
+        return lookup_users()
+
+    role = request.args.get("role")
+
+    # 400 error
+    if role is not None and role not in ROLES:
+        return missing()
+
+    if "limit" in request.args or "cursor" in request.args:
+        return page_users(role)
+
+    ndjson = (request.args.get("format") == "ndjson" or
+              request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+              == "application/x-ndjson")
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_users(store.users.stream(role), ndjson), 200, mimetype=mimetype)
+
+def page_users(role):
+    """
+    One page of users from a projection query.
+    """
+    try:
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return missing()
+
+    # 400 error
+    if not 0 < limit <= GET_LIMIT:
+        return missing()
+
+    try:
+        users, next_cursor = store.users.page(limit, request.args.get("cursor"), role)
+    # 400 error - bad cursor
+    except InvalidCursor:
+        return missing()
+
+    response = {
+        "users": users
+    }
+
+    if next_cursor:
+        next_url = f"{request.host_url}users?cursor={quote(next_cursor)}&limit={limit}"
+        if role:
+            next_url += f"&role={role}"
+        response.update({"next": next_url})
+
+    return (jsonify(response), 200)
+
+def stream_users(users, ndjson):
+    """
+    Writes users as they're fetched, STREAM_BATCH per chunk, as NDJSON or
+    one JSON array.
+    """
+    if not ndjson:
+        yield "["
+
+    first = True
+    batch = []
+    for user in users:
+        batch.append(user)
+        if len(batch) < STREAM_BATCH:
+            continue
+
+        yield stream_chunk(batch, ndjson, first)
+        first = False
+        batch = []
+
+    if batch:
+        yield stream_chunk(batch, ndjson, first)
+
+    if not ndjson:
+        yield "]\n"
+
+def stream_chunk(users, ndjson, first):
+    if ndjson:
+        return "".join(ENCODER.encode(user) + "\n" for user in users)
+
+    # the batch's array without its brackets
+    return ("" if first else ",") + ENCODER.encode(users)[1:-1]
+
+def lookup_users():
+    """
+    Bulk form of GET /users/<id> for rosters: one batched lookup for the
+    users and, with ?avatar=true, a concurrent avatar check per user found.
+    """
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args["ids"].split(",") if id))
+    except ValueError:
+        return missing()
+
+    # 400 error
+    if not ids or len(ids) > GET_LIMIT:
+        return missing()
+
+    users = load_users(ids)
+
+    with_avatar = set()
+    if request.args.get("avatar") == "true":
+        with_avatar = store.avatars.with_avatars(users)
+
     response = []
+    for id in ids:
+        user = users.get(id)
+        if user is None:
+            continue
 
-    # modular design
-    for result in results:
         result_data = {
-            "id": result.key.id,
-            "role": result.get("role"),
-            "sub": result.get("sub")
+            "id": id,
+            "role": user.get("role"),
+            "sub": user.get("sub")
         }
+        if id in with_avatar:
+            result_data["avatar_url"] = f"{request.host_url}users/{id}/avatar"
         response.append(result_data)
-    
+
     return (jsonify(response), 200)
 
 @bp.route('/<int:id>', methods=['GET'])
@@ -84,36 +187,32 @@ def get_user(id):
     Detailed summary about the user, including avatar and courses.\n
     Protection: Admin or JWT matching id
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    # 403 error
-    else:
-        sub = sub[0]
-    
-    # avatar
-    result_data = {}
-
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(AVATAR_BUCKET)
-    blob = bucket.blob(f"users/{id}/avatar.png")
-
-    if blob.exists():
-        result_data["avatar_url"] = f"{request.host_url}users/{id}/avatar"
-
-    user = client.get(key=client.key("users", id))
+    # the caller's principal, the avatar and the user (with their course
+    # index) are independent, so the lookups don't wait on authorization
+    _, has_avatar, (user, courses) = fanout.gather(
+        current_caller,
+        lambda: store.avatars.exists(id),
+        lambda: store.users.get_with_courses(id)
+    )
+    remember("users", id, user)
+
+    # 401/403/404 error - the caller is in g, the user just loaded
+    auth_error = authorize([admin_or_self], {"id": id})
+    if auth_error:
+        return auth_error
 
+    # 404 error
     if user is None:
         return no_result()
-    
+
     role = user.get("role")
     user_sub = user.get("sub")
 
-    permission_error = permission(sub, user_sub)
-    if permission_error:
-        return permission_error
-    
+    result_data = {}
+
+    if has_avatar:
+        result_data["avatar_url"] = f"{request.host_url}users/{id}/avatar"
+
     result_data.update({
         "id": id,
         "role": role,
@@ -126,27 +225,7 @@ def get_user(id):
         return (jsonify(result_data), 200)
 
     # instructors & students
-    courses = []
-
-    if role == "instructor":
-        query = client.query(kind="courses")
-        query.add_filter("instructor_id", "=", id)
-        results = list(query.fetch())
-
-        for r in results:
-            courses.append(r.key.id)
-        
-        result_data.update({
-            "courses": courses
-        })
-    elif role == "student":
-        query = client.query(kind="enrollments")
-        query.add_filter("student_id", "=", id)
-        results = list(query.fetch())
-
-        for r in results:
-            courses.append(r.key.id)
-        
+    if role in ("instructor", "student"):
         result_data.update({
             "courses": courses
         })
@@ -156,36 +235,43 @@ def get_user(id):
 @bp.route('/<int:id>/avatar', methods=['POST'])
 def create_avatar(id):
     """
-    Create/update a user's avatar.
+    Create/update a user's avatar. Stored as a normalized PNG plus the
+    AVATAR_SIZES thumbnails.
     Protection: User with JWT matching id
     """
-    if 'file' not in request.files:
-        return missing()
-
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-
-    sub = sub[0]
+    limit = current_app.config['AVATAR_MAX_BYTES']
+
+    # 413 error - don't parse a body that can't fit, chunked ones included
+    request.max_content_length = limit + MULTIPART_OVERHEAD
+    try:
+        if 'file' not in request.files:
+            return missing()
+    except RequestEntityTooLarge:
+        return too_large()
+
+    # 401/403/404 error - after the cheap body checks, as before
+    owner_error = authorize([owner], {"id": id})
+    if owner_error:
+        return owner_error
+    
+    file_obj = request.files['file']
+    file_obj.seek(0)
 
-    user = client.get(key=client.key("users", id))
+    # 413 error
+    data = images.read_limited(file_obj.stream, limit)
+    if data is None:
+        return too_large()
 
-    if user is None:
-        return no_result()
-    
-    user_sub = user.get("sub")
+    # 400 error - not an image
+    if images.sniff(data) is None:
+        return missing()
 
-    if sub != user_sub:
-        return no_id_found()
-    
-    file_obj = request.files['file']
+    try:
+        variants = images.process(data, store.avatars.sizes, current_app.config['IMAGE_WORKERS'])
+    except images.ImageError:
+        return missing()
 
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(AVATAR_BUCKET)
-    blob = bucket.blob(f"users/{id}/avatar.png")
-    file_obj.seek(0)
-    blob.upload_from_file(file_obj)
+    store.avatars.upload(id, variants)
 
     blob_url = f"{request.host_url}users/{id}/avatar"
 
@@ -200,74 +286,97 @@ def create_avatar(id):
 @bp.route('/<int:id>/avatar', methods=['GET'])
 def get_avatar(id):
     """
-    Gets an avatar based on user id.
+    Gets an avatar based on user id. ?size= picks one of the AVATAR_SIZES
+    thumbnails.
     Protection: User with JWT matching id
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    
-    sub = sub[0]
-
-    user = client.get(key=client.key("users", id))
+    size = request.args.get("size", type=int)
 
-    if user is None:
-        return no_result()
-    
-    user_sub = user.get("sub")
+    # 400 error
+    if "size" in request.args and size not in store.avatars.sizes:
+        return missing()
 
-    # 403 error
-    if sub != user_sub:
-        return no_id_found()
+    # 401/403/404 error
+    owner_error = authorize([owner], {"id": id})
+    if owner_error:
+        return owner_error
     
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(AVATAR_BUCKET)
-    blob = bucket.blob(f"users/{id}/avatar.png")
+    # avatars uploaded before variants existed only have the original
+    blob = None
+    if size is not None:
+        blob = store.avatars.stat(id, size)
+        if blob is None:
+            size = None
+
+    # signed url mode - GCS serves the bytes (and the 404)
+    if current_app.config['AVATAR_DELIVERY'] == "redirect":
+        url = store.avatars.signed_url(id, current_app.config['AVATAR_URL_EXPIRY'], size)
+        # no URL (memory backend, or credentials that can't sign) - stream it
+        if url:
+            return redirect(url, 302)
+
+    if blob is None:
+        blob = store.avatars.stat(id)
 
     # 404 error
-    if not blob.exists():
+    if blob is None:
         return no_result()
 
-    file_obj = io.BytesIO()
-    blob.download_to_file(file_obj)
-    file_obj.seek(0)
-    
-    return send_file(file_obj, mimetype='image/x-png', download_name="avatar.png")
+    etag = blob.md5_hash or str(blob.generation)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"private, max-age={current_app.config['AVATAR_MAX_AGE']}",
+        "Accept-Ranges": "bytes"
+    }
+
+    # 304 - answered from metadata alone
+    if request.if_none_match.contains_weak(etag):
+        return ("", 304, headers)
+
+    # ranges only apply to the version the client already has, and a
+    # multi-range request gets the whole avatar rather than multipart
+    byte_range = request.range
+    if request.if_range.etag and request.if_range.etag != etag:
+        byte_range = None
+    if byte_range is not None and len(byte_range.ranges) != 1:
+        byte_range = None
+
+    start, stop, status = 0, blob.size, 200
+    if byte_range is not None:
+        bounds = byte_range.range_for_length(blob.size)
+
+        # 416 error
+        if bounds is None:
+            headers["Content-Range"] = f"bytes */{blob.size}"
+            return ("", 416, headers)
+
+        start, stop = bounds
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{blob.size}"
+
+    headers.update({
+        "Content-Length": str(stop - start),
+        "Content-Disposition": "inline; filename=avatar.png"
+    })
+
+    # small avatars come from the cache, big ones stream from GCS
+    data = store.avatars.read(blob)
+    body = [data[start:stop]] if data is not None else store.avatars.stream(blob, start, stop)
+
+    return Response(body, status, headers, mimetype='image/x-png',
+                    direct_passthrough=True)
 
 @bp.route('/<int:id>/avatar', methods=['DELETE'])
+@requires(owner)
 def delete_avatar(id):
     """
     Delete an avatar based on user id.
     Protection: User with JWT matching id
     """
-    sub = jwt_invalid(request)
-    # 401 error
-    if sub[1]:
-        return sub[0]
-    
-    sub = sub[0]
-
-    user = client.get(key=client.key("users", id))
-
-    # 404 error
-    if user is None:
-        return no_result()
-    
-    user_sub = user.get("sub")
-
-    # 403 error
-    if sub != user_sub:
-        return no_id_found()
-
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(AVATAR_BUCKET)
-    blob = bucket.blob(f"users/{id}/avatar.png")
-
     # 404 error
-    if not blob.exists():
+    if not store.avatars.exists(id):
         return no_result()
 
-    blob.delete()
+    store.avatars.delete(id)
 
     return ("", 204)
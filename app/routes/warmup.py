@@ -0,0 +1,47 @@
+from flask import Blueprint, current_app, jsonify
+from app import key_store, store, broker, fanout, startup
+from app.routes import courses
+
+bp = Blueprint('warmup', __name__)
+
+def warmup_steps():
+    """
+    (name, call) for each connection and cache a cold instance fills on
+    its first requests otherwise.
+    """
+    return [
+        ("jwks", key_store.warm),
+        ("datastore", store.backend.warm),
+        ("gcs", store.avatars.warm),
+        ("auth0", broker.warm),
+        # the unfiltered first page is the most requested listing
+        ("catalog", courses.get_courses)
+    ]
+
+def run_step(name, call):
+    """
+    Runs one warmup step, timed. A failure is reported rather than raised,
+    the instance can still serve without it.
+    """
+    with startup.timed("warmup", name):
+        try:
+            call()
+        except Exception as error:
+            startup.failed(name, error)
+            current_app.logger.warning("warmup step %s failed: %s", name, error)
+        else:
+            startup.succeeded(name)
+
+@bp.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    """
+    App Engine warmup request (inbound_services: warmup in app.yaml), sent
+    before a new instance gets traffic. Loads the JWKS, opens Datastore,
+    GCS and Auth0 connections and caches the first catalog page, all
+    concurrently. Returns the startup report.\n
+    Protection: Unprotected
+    """
+    fanout.gather(*[lambda name=name, call=call: run_step(name, call)
+                    for name, call in warmup_steps()])
+
+    return jsonify(startup.report()), 200
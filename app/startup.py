@@ -0,0 +1,45 @@
+import threading
+import time
+from contextlib import contextmanager
+
+PHASES = ["import", "init", "warmup"]
+
+class Startup:
+    """
+    Where a cold start's time goes, in seconds: importing the app package,
+    each step of create_app and each /_ah/warmup step.\n
+    Returned by the warmup request and `flask --app main startup-report`.
+    """
+    def __init__(self):
+        self.phases = {phase: {} for phase in PHASES}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, phase, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[phase][name] = elapsed
+
+    def failed(self, name, error):
+        with self._lock:
+            self.errors[name] = f"{type(error).__name__}: {error}"
+
+    def succeeded(self, name):
+        with self._lock:
+            self.errors.pop(name, None)
+
+    def report(self):
+        """
+        {phase: {step: seconds}, "total": {phase: seconds}, "errors": {step: error}}
+        """
+        with self._lock:
+            report = {phase: dict(steps) for phase, steps in self.phases.items()}
+            report["total"] = {phase: sum(steps.values()) for phase, steps in self.phases.items()}
+            report["errors"] = dict(self.errors)
+
+        return report
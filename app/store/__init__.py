@@ -0,0 +1,87 @@
+COURSE_FIELDS = ["subject", "number", "title", "term", "instructor_id"]
+
+# course listings Datastore has an index for, {equality filters: sorts}.
+# "-" sorts descending, and a number range needs a number sort. index.yaml
+# has the composite indexes, keep the two in step.
+COURSE_QUERIES = {
+    (): ["subject", "-subject", "number", "-number", "term", "-term"],
+    ("term",): ["subject", "number", "-number"],
+    ("subject",): ["number", "-number", "term", "-term"],
+    ("instructor_id",): ["subject", "term", "-term"],
+    ("subject", "term"): ["number"],
+    ("instructor_id", "term"): ["subject"]
+}
+
+class InvalidCursor(Exception):
+    pass
+
+class UnsupportedQuery(Exception):
+    pass
+
+def course_sort(filters, sort=None, ranged=False):
+    """
+    The sort for a course listing: sort, or the default for its filters.
+    Raises UnsupportedQuery when COURSE_QUERIES has no index for it.
+    """
+    sorts = COURSE_QUERIES.get(tuple(sorted(filters)))
+    if sorts is None:
+        raise UnsupportedQuery(sorted(filters))
+
+    if sort is None:
+        # a range has to sort on the ranged property first
+        numbered = [option for option in sorts if option.lstrip("-") == "number"]
+        sort = numbered[0] if ranged and numbered else sorts[0]
+
+    if sort not in sorts or (ranged and sort.lstrip("-") != "number"):
+        raise UnsupportedQuery(sort)
+
+    return sort
+
+class Store:
+    """
+    The persistence layer the routes and app.utility talk to, instead of the
+    Datastore and Cloud Storage clients.\n
+    init_app picks the backend from BACKEND: "cloud" (Datastore + GCS) or
+    "memory" (in-process, for load tests and profiling without GCP).
+    Each backend has users, courses, enrollments and avatars repositories.
+    """
+    def __init__(self):
+        self.backend = None
+        self.users = None
+        self.courses = None
+        self.enrollments = None
+        self.avatars = None
+        self.record = None
+        self.deadline = None
+        self._user_callbacks = []
+
+    def init_app(self, app):
+        if app.config.get('BACKEND') == "memory":
+            from .memory import MemoryBackend
+            self.backend = MemoryBackend(app, self)
+        else:
+            from .cloud import CloudBackend
+            self.backend = CloudBackend(app, self)
+
+        self.users = self.backend.users
+        self.courses = self.backend.courses
+        self.enrollments = self.backend.enrollments
+        self.avatars = self.backend.avatars
+
+    def on_user_change(self, callback):
+        """
+        Registers callback(sub) to run when a user entity is written.
+        """
+        if callback not in self._user_callbacks:
+            self._user_callbacks.append(callback)
+
+    def user_changed(self, sub):
+        for callback in self._user_callbacks:
+            callback(sub)
+
+    def timing(self, name, seconds):
+        """
+        Reports time spent in a backend call to the record(name, seconds) hook.
+        """
+        if self.record is not None:
+            self.record(name, seconds)
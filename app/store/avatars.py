@@ -0,0 +1,289 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import Signing
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import Request
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from ..cache import ByteCache
+from ..deadline import DeadlineExceeded, TIMEOUT_ERRORS
+
+# the client's own per-call timeout, the most a budget hands out
+GCS_TIMEOUT = 60
+
+class AvatarStore:
+    """
+    App-scoped Cloud Storage access for avatars.\n
+    One client (and its connection pool) and one bucket handle are shared by
+    every request, built on first use. bucket() doesn't make an RPC, unlike
+    get_bucket().
+    """
+    def __init__(self):
+        self._client = None
+        self._bucket = None
+        self.bucket_name = None
+        self.pool_size = 10
+        self.chunk_size = 256 * 1024
+        self.cache = ByteCache()
+        self.max_cached = 1024 * 1024
+        self.sizes = ()
+        self._pool = None
+        self.record = None
+        self.deadline = None
+        self._timings = {}
+        self._lock = threading.Lock()
+        self._client_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.bucket_name = app.config.get('AVATAR_BUCKET')
+        self.pool_size = app.config.get('STORAGE_POOL_SIZE', self.pool_size)
+        self.sizes = tuple(app.config.get('AVATAR_SIZES', ()))
+        self._pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="avatars")
+        self.chunk_size = app.config.get('AVATAR_CHUNK_SIZE', self.chunk_size)
+
+        # hot avatars: memory first, then a per-process spill directory
+        self.max_cached = app.config.get('AVATAR_CACHE_MAX_ITEM', self.max_cached)
+        self.cache.memory_bytes = app.config.get('AVATAR_CACHE_BYTES', self.cache.memory_bytes)
+        self.cache.disk_bytes = app.config.get('AVATAR_DISK_CACHE_BYTES', self.cache.disk_bytes)
+        if self.cache.disk_bytes and self.cache.directory is None:
+            base = app.config.get('AVATAR_CACHE_DIR') or tempfile.gettempdir()
+            os.makedirs(base, exist_ok=True)
+            self.cache.directory = tempfile.mkdtemp(prefix="avatars-", dir=base)
+
+    @property
+    def client(self):
+        """
+        The storage client, built on first use: credential lookup and the
+        HTTP session wait until a request (or /_ah/warmup) needs them.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    client = storage.Client()
+
+                    # default requests pool is 10 connections, size it to the workers
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    client._http.mount("https://", adapter)
+
+                    self._bucket = client.bucket(self.bucket_name)
+                    self._client = client
+
+        return self._client
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            # building the client makes the bucket handle too
+            self.client
+
+        return self._bucket
+
+    def warm(self):
+        """
+        Builds the client and lists one blob, leaving a pooled connection open.
+        """
+        with self.timed("list"):
+            list(self.bucket.list_blobs(prefix="users/", max_results=1, fields="items(name)",
+                                        **self.options(read=True)))
+
+    def path(self, id, size=None):
+        if size is None:
+            return f"users/{id}/avatar.png"
+
+        return f"users/{id}/avatar_{size}.png"
+
+    def blob(self, id, size=None):
+        return self.bucket.blob(self.path(id, size))
+
+    def exists(self, id):
+        return self.hedged("exists", lambda: self._exists(id))
+
+    def _exists(self, id):
+        with self.timed("exists"):
+            return self.blob(id).exists(**self.options(read=True))
+
+    def with_avatars(self, ids):
+        """
+        The subset of user ids that have an avatar, one concurrent metadata
+        check per id: the cost follows the ids asked for, not the bucket.
+        """
+        ids = list(ids)
+        # the pool threads are outside the request, so take the budget here
+        options = self.options(read=True)
+
+        def check(id):
+            with self.timed("exists"):
+                return self.blob(id).exists(**options)
+
+        return {id for id, found in zip(ids, self._pool.map(check, ids)) if found}
+
+    def upload(self, id, variants):
+        """
+        Uploads {size: png bytes} (None is the original) concurrently.
+        """
+        # the pool threads are outside the request, so take the budget here
+        options = self.options()
+
+        def put(size, data):
+            with self.timed("upload"):
+                self.blob(id, size).upload_from_string(data, content_type="image/png", **options)
+            self.cache.invalidate(self.path(id, size))
+
+        futures = [self._pool.submit(put, size, data) for size, data in variants.items()]
+        for future in futures:
+            future.result()
+
+    def stat(self, id, size=None):
+        """
+        The avatar blob with its metadata (generation, md5, size) loaded, or
+        None if there isn't one. One metadata RPC, no bytes.
+        """
+        return self.hedged("stat", lambda: self._stat(id, size))
+
+    def _stat(self, id, size):
+        blob = self.blob(id, size)
+        with self.timed("stat"):
+            try:
+                blob.reload(**self.options(read=True))
+            except NotFound:
+                return None
+
+        return blob
+
+    def read(self, blob):
+        """
+        All of blob's bytes, from the cache if the generation still matches.
+        None if it's too big to cache - stream() it instead.
+        """
+        if blob.size > self.max_cached:
+            return None
+
+        data = self.cache.get(blob.name, blob.generation)
+        if data is None:
+            pinned = self.bucket.blob(blob.name, generation=blob.generation)
+            with self.timed("download"):
+                data = pinned.download_as_bytes(**self.options(read=True))
+            self.cache.set(blob.name, blob.generation, data)
+
+        return data
+
+    def stream(self, blob, start=0, stop=None):
+        """
+        Yields the bytes of blob[start:stop] in chunk_size pieces, pinned to
+        the generation stat() saw.
+        """
+        stop = blob.size if stop is None else stop
+        pinned = self.bucket.blob(blob.name, generation=blob.generation)
+
+        with self.timed("stream"):
+            with pinned.open("rb", chunk_size=self.chunk_size) as reader:
+                reader.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = reader.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+    def signed_url(self, id, expires, size=None):
+        """
+        Short-lived V4 signed GET URL, so the bytes skip our workers. None if
+        the credentials can't sign, the route streams instead.
+        """
+        with self.timed("sign"):
+            try:
+                return self.blob(id, size).generate_signed_url(
+                    version="v4",
+                    expiration=timedelta(seconds=expires),
+                    method="GET",
+                    **self.signer()
+                )
+            except (AttributeError, GoogleAuthError):
+                return None
+
+    def signer(self):
+        """
+        Extra generate_signed_url kwargs for credentials without a private
+        key (App Engine's default service account): sign through IAM
+        signBlob with the account's email and a fresh access token.
+        """
+        credentials = self.client._credentials
+        if isinstance(credentials, Signing):
+            return {}
+
+        if not credentials.valid:
+            credentials.refresh(Request())
+
+        return {
+            "service_account_email": credentials.service_account_email,
+            "access_token": credentials.token
+        }
+
+    def delete(self, id):
+        """
+        Deletes the avatar and every size variant of it.
+        """
+        blobs = [self.blob(id, size) for size in (None,) + self.sizes]
+        with self.timed("delete"):
+            # older uploads have no variants
+            self.bucket.delete_blobs(blobs, on_error=lambda blob: None, **self.options())
+
+        for blob in blobs:
+            self.cache.invalidate(blob.name)
+
+    def options(self, read=False):
+        """
+        timeout/retry kwargs for a GCS call from the request's budget.
+        """
+        if self.deadline is None:
+            return {}
+
+        return self.deadline.options(read, cap=GCS_TIMEOUT)
+
+    def hedged(self, op, call):
+        if self.deadline is None:
+            return call()
+
+        return self.deadline.hedged(f"gcs.{op}", call)
+
+    @contextmanager
+    def timed(self, op):
+        start = time.perf_counter()
+        try:
+            yield
+        except TIMEOUT_ERRORS as error:
+            raise DeadlineExceeded() from error
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                count, total, worst = self._timings.get(op, (0, 0.0, 0.0))
+                self._timings[op] = (count + 1, total + elapsed, max(worst, elapsed))
+
+            if self.record is not None:
+                self.record("gcs", elapsed)
+
+    def timings(self, field):
+        """
+        {op: value} for one per-call timing: "count", "total" or "max" (seconds).
+        """
+        index = ("count", "total", "max").index(field)
+        with self._lock:
+            return {op: timing[index] for op, timing in self._timings.items()}
+
+    def collectors(self):
+        """
+        (name, collect, gauges) for each set of stats /metrics exports.
+        """
+        return [
+            ("gcs_calls", partial(self.timings, "count"), ()),
+            ("gcs_call_seconds", partial(self.timings, "total"), ()),
+            ("avatar_cache", self.cache.stats, ("memory_bytes", "disk_bytes"))
+        ]
@@ -0,0 +1,596 @@
+import functools
+import threading
+import time
+from google.api_core.exceptions import BadRequest
+from google.cloud import datastore
+from . import COURSE_FIELDS, InvalidCursor
+from .avatars import AvatarStore
+from ..deadline import DeadlineExceeded, TIMEOUT_ERRORS
+
+# Datastore caps on a single get_multi / commit
+GET_LIMIT = 1000
+BATCH_SIZE = 500
+
+# each enrollment change also writes the student's course index
+INDEX_BATCH_SIZE = BATCH_SIZE // 2
+
+# and removing one deletes its pre-migration row as well
+LEGACY_BATCH_SIZE = BATCH_SIZE // 3
+
+def chunks(items, size=BATCH_SIZE):
+    """
+    Splits items into lists of at most size, for the batch RPCs.
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def page_token(iterator):
+    """
+    The cursor where a fetch stopped, as a URL-safe string (None at the end).
+    """
+    token = iterator.next_page_token
+    if isinstance(token, bytes):
+        token = token.decode()
+
+    return token
+
+def enrollment_ids(key):
+    """
+    (course_id, student_id) from an enrollment key.
+    """
+    course_id, student_id = key.name.split(":")
+    return (int(course_id), int(student_id))
+
+def enrollment_pairs(client, keys, **options):
+    """
+    (course_id, student_id) for each enrollment key. Auto-id keys from
+    before migrate-enrollments don't carry the ids, so those rows are read.
+    """
+    legacy = [key for key in keys if key.name is None]
+    found = {}
+    for chunk in chunks(legacy, GET_LIMIT):
+        for entity in client.get_multi(chunk, **options):
+            found[entity.key] = (entity.get("course_id"), entity.get("student_id"))
+
+    return [enrollment_ids(key) if key.name is not None else found[key]
+            for key in keys if key.name is not None or key in found]
+
+def rpc(method):
+    """
+    Reports the time a repository method spends in Datastore as "datastore".
+    A call that times out raises DeadlineExceeded.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except TIMEOUT_ERRORS as error:
+            raise DeadlineExceeded() from error
+        finally:
+            self.backend.store.timing("datastore", time.perf_counter() - start)
+
+    return wrapper
+
+def read(method):
+    """
+    rpc for idempotent reads, which may be hedged (see Deadline.hedged).
+    """
+    timed = rpc(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.backend.hedged(method.__qualname__, lambda: timed(self, *args, **kwargs))
+
+    return wrapper
+
+def user_record(entity):
+    return {
+        "id": entity.key.id,
+        "role": entity.get("role"),
+        "sub": entity.get("sub")
+    }
+
+def user_summary(entity, role=None):
+    """
+    user_record for a projection entity, role from the filter if there was one.
+    """
+    return {
+        "id": entity.key.id,
+        "role": role or entity.get("role"),
+        "sub": entity.get("sub")
+    }
+
+def course_record(entity):
+    record = {"id": entity.key.id}
+    for field in COURSE_FIELDS:
+        record[field] = entity.get(field)
+
+    return record
+
+class CloudBackend:
+    """
+    Datastore for users, courses and enrollments, Cloud Storage for avatars.
+    """
+    def __init__(self, app, store):
+        self.store = store
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.users = CloudUsers(self)
+        self.courses = CloudCourses(self)
+        self.enrollments = CloudEnrollments(self)
+        self.avatars = AvatarStore()
+        self.avatars.init_app(app)
+        self.avatars.record = store.timing
+        self.avatars.deadline = store.deadline
+
+    @property
+    def client(self):
+        """
+        The Datastore client, built on first use. Building one looks up
+        credentials, which on App Engine is a metadata server round trip.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+
+        return self._client
+
+    def warm(self):
+        """
+        Builds the client and makes one lookup, so credentials and the
+        channel are ready before a request needs them.
+        """
+        self.client.get(self.client.key("users", 1), **self.options(read=True))
+
+    def options(self, read=False):
+        """
+        timeout/retry kwargs for a Datastore call from the request's budget.
+        """
+        deadline = self.store.deadline
+        return deadline.options(read) if deadline is not None else {}
+
+    def hedged(self, name, call):
+        deadline = self.store.deadline
+        return deadline.hedged(name, call) if deadline is not None else call()
+
+    def transaction(self):
+        """
+        client.transaction(), refused up front once the budget is spent.
+        """
+        self.options()
+        return self.client.transaction()
+
+    def get_multi(self, kind, ids):
+        """
+        Fetches entities by id with as few RPCs as possible. Returns {id: entity}.
+        """
+        keys = [self.client.key(kind, id) for id in ids]
+        entities = {}
+        for chunk in chunks(keys, GET_LIMIT):
+            for entity in self.client.get_multi(chunk, **self.options(read=True)):
+                entities[entity.key.id_or_name] = entity
+
+        return entities
+
+    def enrollment_key(self, course_id, student_id):
+        """
+        Enrollments are keyed "course_id:student_id", so membership is a key lookup.
+        """
+        return self.client.key("enrollments", f"{course_id}:{student_id}")
+
+    def index_key(self, user_id):
+        return self.client.key("user_courses", user_id)
+
+    def update_course_index(self, changes):
+        """
+        Applies {user_id: (added course ids, removed course ids)} to the
+        per-user course index. Call inside the transaction making the change.
+        """
+        if not changes:
+            return
+
+        existing = self.get_multi("user_courses", changes)
+
+        updated = []
+        for user_id, (added, removed) in changes.items():
+            entity = existing.get(user_id)
+            if entity is None:
+                entity = datastore.Entity(key=self.index_key(user_id),
+                                          exclude_from_indexes=("courses",))
+
+            courses = set(entity.get("courses", []))
+            courses.difference_update(removed)
+            courses.update(added)
+            entity["courses"] = sorted(courses)
+            updated.append(entity)
+
+        for chunk in chunks(updated):
+            self.client.put_multi(chunk)
+
+class CloudUsers:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def client(self):
+        return self.backend.client
+
+    @read
+    def get(self, id):
+        entity = self.client.get(key=self.client.key("users", id), **self.backend.options(read=True))
+        return user_record(entity) if entity is not None else None
+
+    @read
+    def get_multi(self, ids):
+        """
+        {id: user} for the ids that exist.
+        """
+        return {id: user_record(entity)
+                for id, entity in self.backend.get_multi("users", ids).items()}
+
+    @read
+    def by_sub(self, sub):
+        query = self.client.query(kind="users")
+        query.add_filter("sub", "=", sub)
+        results = list(query.fetch(limit=1, **self.backend.options(read=True)))
+        return user_record(results[0]) if results else None
+
+    @read
+    def page(self, limit, cursor=None, role=None):
+        """
+        One page of user summaries from a projection query. Returns (users,
+        cursor for the next page or None).
+        """
+        query = self._summary_query(role)
+        try:
+            iterator = query.fetch(start_cursor=cursor, limit=limit, **self.backend.options(read=True))
+            users = [user_summary(entity, role) for entity in iterator]
+        except (ValueError, BadRequest):
+            raise InvalidCursor(cursor)
+
+        next_cursor = page_token(iterator)
+        if len(users) < limit or not next_cursor:
+            return (users, None)
+
+        return (users, next_cursor)
+
+    def stream(self, role=None):
+        """
+        Yields every user summary, fetching in batches as it goes.
+        """
+        for entity in self._summary_query(role).fetch(**self.backend.options(read=True)):
+            yield user_summary(entity, role)
+
+    def _summary_query(self, role):
+        # an equality-filtered property can't also be projected
+        if role is None:
+            return self.client.query(kind="users", projection=["role", "sub"])
+
+        query = self.client.query(kind="users", projection=["sub"])
+        query.add_filter("role", "=", role)
+        return query
+
+    @read
+    def get_with_courses(self, id):
+        """
+        (user, course ids) in one lookup. user is None if there's no such user.
+        """
+        found = {}
+        keys = [self.client.key("users", id), self.backend.index_key(id)]
+        for entity in self.client.get_multi(keys, **self.backend.options(read=True)):
+            found[entity.key.kind] = entity
+
+        user = found.get("users")
+        index = found.get("user_courses")
+        courses = list(index.get("courses", [])) if index is not None else []
+        return (user_record(user) if user is not None else None, courses)
+
+    @rpc
+    def put(self, user):
+        """
+        Creates or replaces a user. Returns it with its id.
+        """
+        key = self.client.key("users", user["id"]) if user.get("id") else self.client.key("users")
+        entity = datastore.Entity(key=key)
+        entity.update({"role": user.get("role"), "sub": user.get("sub")})
+        self.client.put(entity, **self.backend.options())
+
+        self.backend.store.user_changed(entity.get("sub"))
+        return user_record(entity)
+
+class CloudCourses:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def client(self):
+        return self.backend.client
+
+    @read
+    def get(self, id):
+        entity = self.client.get(key=self.client.key("courses", id), **self.backend.options(read=True))
+        return course_record(entity) if entity is not None else None
+
+    @read
+    def get_multi(self, ids):
+        """
+        {id: course} for the ids that exist.
+        """
+        return {id: course_record(entity)
+                for id, entity in self.backend.get_multi("courses", ids).items()}
+
+    @read
+    def page(self, limit, cursor=None, filters=None, sort="subject", number=(None, None)):
+        """
+        One page of the courses matching the {property: value} filters and
+        the inclusive number range, in sort order (see COURSE_QUERIES).
+        Returns (courses, cursor for the next page or None on the last one).
+        """
+        query = self.client.query(kind="courses")
+        for name, value in (filters or {}).items():
+            query.add_filter(name, "=", value)
+
+        low, high = number
+        if low is not None:
+            query.add_filter("number", ">=", low)
+        if high is not None:
+            query.add_filter("number", "<=", high)
+
+        query.order = [sort]
+
+        try:
+            iterator = query.fetch(start_cursor=cursor, limit=limit, **self.backend.options(read=True))
+            courses = [course_record(entity) for entity in iterator]
+        except (ValueError, BadRequest):
+            raise InvalidCursor(cursor)
+
+        next_cursor = page_token(iterator)
+        if len(courses) < limit or not next_cursor:
+            return (courses, None)
+
+        # keys-only probe for one more row
+        query.keys_only()
+        if not list(query.fetch(start_cursor=next_cursor, limit=1, **self.backend.options(read=True))):
+            return (courses, None)
+
+        return (courses, next_cursor)
+
+    @read
+    def page_offset(self, offset, limit):
+        """
+        Offset/limit page for older clients. Returns (courses, more).
+        """
+        query = self.client.query(kind="courses")
+        query.order = ["subject"]
+
+        # one extra row says whether there's a next page, no count needed
+        results = list(query.fetch(offset=offset, limit=limit + 1, **self.backend.options(read=True)))
+        courses = [course_record(entity) for entity in results[:limit]]
+        return (courses, len(results) > limit)
+
+    @rpc
+    def create(self, data):
+        """
+        Creates a course and adds it to the instructor's course index.
+        """
+        # id up front so the index can go in the same transaction
+        key = self.client.allocate_ids(self.client.key("courses"), 1, **self.backend.options())[0]
+        entity = datastore.Entity(key=key)
+        entity.update({field: data[field] for field in COURSE_FIELDS})
+
+        with self.backend.transaction():
+            self.client.put(entity)
+            self.backend.update_course_index({data["instructor_id"]: ([key.id], [])})
+
+        return course_record(entity)
+
+    @rpc
+    def create_many(self, rows):
+        """
+        Creates courses in bulk, one transaction (ids, puts and instructors'
+        index) per INDEX_BATCH_SIZE. Returns the course records in order.
+        """
+        created = []
+        for chunk in chunks(rows, INDEX_BATCH_SIZE):
+            keys = self.client.allocate_ids(self.client.key("courses"), len(chunk),
+                                            **self.backend.options())
+
+            entities = []
+            changes = {}
+            for key, data in zip(keys, chunk):
+                entity = datastore.Entity(key=key)
+                entity.update({field: data[field] for field in COURSE_FIELDS})
+                entities.append(entity)
+                changes.setdefault(data["instructor_id"], ([], []))[0].append(key.id)
+
+            with self.backend.transaction():
+                self.client.put_multi(entities)
+                self.backend.update_course_index(changes)
+
+            created.extend(course_record(entity) for entity in entities)
+
+        return created
+
+    @rpc
+    def update(self, course, data):
+        """
+        Writes course with the COURSE_FIELDS in data applied, moving it
+        between instructors' indexes if that changed. Returns the new course.
+        """
+        updated = dict(course)
+        for field in COURSE_FIELDS:
+            if field in data:
+                updated[field] = data[field]
+
+        entity = datastore.Entity(key=self.client.key("courses", course["id"]))
+        entity.update({field: updated[field] for field in COURSE_FIELDS})
+
+        changes = {}
+        if updated["instructor_id"] != course["instructor_id"]:
+            changes[course["instructor_id"]] = ([], [course["id"]])
+            changes[updated["instructor_id"]] = ([course["id"]], [])
+
+        with self.backend.transaction():
+            self.client.put(entity)
+            self.backend.update_course_index(changes)
+
+        return updated
+
+    @rpc
+    def delete(self, course):
+        """
+        Deletes the course and drops it from the instructor's index. The
+        enrollments are left to enrollments.remove_all.
+        """
+        with self.backend.transaction():
+            self.client.delete(self.client.key("courses", course["id"]))
+            self.backend.update_course_index({course["instructor_id"]: ([], [course["id"]])})
+
+class CloudEnrollments:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def client(self):
+        return self.backend.client
+
+    @read
+    def students(self, course_id):
+        """
+        Ids of the students in a course, from a keys-only query.
+        """
+        query = self.client.query(kind="enrollments")
+        query.add_filter("course_id", "=", course_id)
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch(**self.backend.options(read=True))]
+        # a student can have a legacy row and a new one until the migration runs
+        return list(dict.fromkeys(student_id for _, student_id in
+                                  enrollment_pairs(self.client, keys, **self.backend.options(read=True))))
+
+    def legacy_keys(self, course_id):
+        """
+        {student_id: [keys]} of a course's auto-id rows from before
+        migrate-enrollments, which deletes by deterministic key miss.
+        """
+        query = self.client.query(kind="enrollments")
+        query.add_filter("course_id", "=", course_id)
+        query.keys_only()
+        legacy = [entity.key for entity in query.fetch() if entity.key.name is None]
+
+        found = {}
+        for chunk in chunks(legacy, GET_LIMIT):
+            for entity in self.client.get_multi(chunk):
+                found.setdefault(entity.get("student_id"), []).append(entity.key)
+
+        return found
+
+    @rpc
+    def update(self, course_id, add, remove):
+        """
+        Enrolls add and disenrolls remove, one transaction (enrollments and
+        students' index) per INDEX_BATCH_SIZE students to stay under the
+        commit cap. Every chunk is idempotent: a failure leaves earlier
+        chunks applied, and retrying the whole update finishes the job.
+        """
+        changes = {student_id: ([course_id], []) for student_id in add}
+        changes.update({student_id: ([], [course_id]) for student_id in remove})
+        legacy = self.legacy_keys(course_id) if remove else {}
+
+        for chunk in chunks(changes, LEGACY_BATCH_SIZE if legacy else INDEX_BATCH_SIZE):
+            # keys are deterministic, re-adding an enrolled student is a no-op put
+            new_enrollments = []
+            removed_keys = []
+            for student_id in chunk:
+                key = self.backend.enrollment_key(course_id, student_id)
+                if changes[student_id][0]:
+                    entity = datastore.Entity(key=key)
+                    entity.update({
+                        "course_id": course_id,
+                        "student_id": student_id
+                    })
+                    new_enrollments.append(entity)
+                else:
+                    removed_keys.append(key)
+                    removed_keys += legacy.get(student_id, [])
+
+            with self.backend.transaction():
+                if new_enrollments:
+                    self.client.put_multi(new_enrollments)
+                if removed_keys:
+                    self.client.delete_multi(removed_keys)
+                self.backend.update_course_index({student_id: changes[student_id]
+                                                  for student_id in chunk})
+
+    @rpc
+    def add_many(self, pairs):
+        """
+        Enrolls (course_id, student_id) pairs, one transaction (enrollments
+        and students' index) per INDEX_BATCH_SIZE. Returns the count.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        for chunk in chunks(pairs, INDEX_BATCH_SIZE):
+            entities = []
+            changes = {}
+            for course_id, student_id in chunk:
+                entity = datastore.Entity(key=self.backend.enrollment_key(course_id, student_id))
+                entity.update({
+                    "course_id": course_id,
+                    "student_id": student_id
+                })
+                entities.append(entity)
+                changes.setdefault(student_id, ([], []))[0].append(course_id)
+
+            with self.backend.transaction():
+                self.client.put_multi(entities)
+                self.backend.update_course_index(changes)
+
+        return len(pairs)
+
+    @read
+    def page(self, limit, cursor=None):
+        """
+        One page of (course_id, student_id) pairs in key order, keys only.
+        Returns (pairs, cursor for the next page or None).
+        """
+        query = self.client.query(kind="enrollments")
+        query.keys_only()
+        try:
+            iterator = query.fetch(start_cursor=cursor, limit=limit, **self.backend.options(read=True))
+            keys = [entity.key for entity in iterator]
+        except (ValueError, BadRequest):
+            raise InvalidCursor(cursor)
+
+        pairs = enrollment_pairs(self.client, keys, **self.backend.options(read=True))
+
+        next_cursor = page_token(iterator)
+        if len(keys) < limit or not next_cursor:
+            return (pairs, None)
+
+        return (pairs, next_cursor)
+
+    @rpc
+    def remove_all(self, course_id, student_ids):
+        """
+        Deletes a course's enrollments and drops the course from the
+        students' index, one transaction per INDEX_BATCH_SIZE chunk. Returns
+        the count.
+        """
+        student_ids = list(dict.fromkeys(student_ids))
+        legacy = self.legacy_keys(course_id)
+
+        deleted = 0
+        for chunk in chunks(student_ids, LEGACY_BATCH_SIZE if legacy else INDEX_BATCH_SIZE):
+            keys = [self.backend.enrollment_key(course_id, student_id) for student_id in chunk]
+            keys += [key for student_id in chunk for key in legacy.get(student_id, [])]
+            changes = {student_id: ([], [course_id]) for student_id in chunk}
+
+            with self.backend.transaction():
+                self.client.delete_multi(keys)
+                self.backend.update_course_index(changes)
+
+            deleted += len(chunk)
+
+        return deleted
@@ -0,0 +1,455 @@
+import base64
+import bisect
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import namedtuple
+from . import COURSE_FIELDS, InvalidCursor
+from ..deadline import DeadlineExceeded
+
+# the blob attributes the avatar routes read
+BlobInfo = namedtuple("BlobInfo", ["name", "generation", "md5_hash", "size"])
+
+class MemoryBackend:
+    """
+    Thread-safe in-process backend for load tests and local profiling.\n
+    Every repository call sleeps MEMORY_LATENCY_MS (plus up to
+    MEMORY_JITTER_MS) to stand in for the RPC it replaces, so application
+    overhead and backend latency can be measured separately.
+    """
+    def __init__(self, app, store):
+        self.store = store
+        self.latency = app.config.get('MEMORY_LATENCY_MS', 0) / 1000
+        self.jitter = app.config.get('MEMORY_JITTER_MS', 0) / 1000
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        # repository calls so far, what benchmarks gate on
+        self.calls = 0
+
+        self.user_rows = {}
+        self.user_order = []
+        self.subs = {}
+        self.course_rows = {}
+        self.course_order = []
+        self.rosters = {}
+        self.index = {}
+
+        self.users = MemoryUsers(self)
+        self.courses = MemoryCourses(self)
+        self.enrollments = MemoryEnrollments(self)
+        self.avatars = MemoryAvatars(self, app)
+
+    def warm(self):
+        """
+        Nothing to connect, kept for the cloud backend's interface.
+        """
+
+    def rpc(self):
+        """
+        Stands in for one backend call: checks the request's budget, then
+        sleeps the modelled latency. A call slower than what's left of the
+        budget times out like a real one.
+        """
+        with self.lock:
+            self.calls += 1
+
+        timeout = self.store.deadline.timeout() if self.store.deadline is not None else None
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            self.store.timing("memory", timeout)
+            raise DeadlineExceeded()
+
+        if delay:
+            time.sleep(delay)
+            self.store.timing("memory", delay)
+
+    def update_course_index(self, changes):
+        for user_id, (added, removed) in changes.items():
+            courses = self.index.setdefault(user_id, set())
+            courses.difference_update(removed)
+            courses.update(added)
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor, types):
+    """
+    The position in cursor, checked against types (one per field, None for
+    any). A cursor that isn't one we made raises InvalidCursor.
+    """
+    try:
+        position = tuple(json.loads(base64.urlsafe_b64decode(cursor)))
+    except Exception:
+        raise InvalidCursor(cursor)
+
+    # bool is an int to isinstance, but never in a cursor of ours
+    if len(position) != len(types) or not all(
+            kind is None or (isinstance(value, kind) and not isinstance(value, bool))
+            for value, kind in zip(position, types)):
+        raise InvalidCursor(cursor)
+
+    return position
+
+class MemoryUsers:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, id):
+        self.backend.rpc()
+        with self.backend.lock:
+            user = self.backend.user_rows.get(id)
+            return dict(user) if user is not None else None
+
+    def get_multi(self, ids):
+        self.backend.rpc()
+        with self.backend.lock:
+            rows = self.backend.user_rows
+            return {id: dict(rows[id]) for id in ids if id in rows}
+
+    def by_sub(self, sub):
+        self.backend.rpc()
+        with self.backend.lock:
+            id = self.backend.subs.get(sub)
+            return dict(self.backend.user_rows[id]) if id is not None else None
+
+    def page(self, limit, cursor=None, role=None):
+        self.backend.rpc()
+        start = 0
+        with self.backend.lock:
+            order = self.backend.user_order
+            if cursor is not None:
+                start = bisect.bisect_right(order, decode_cursor(cursor, (int,))[0])
+
+            users = []
+            for id in order[start:]:
+                user = self.backend.user_rows[id]
+                if role is None or user["role"] == role:
+                    users.append(dict(user))
+                    if len(users) == limit:
+                        break
+
+        if len(users) < limit:
+            return (users, None)
+
+        return (users, encode_cursor([users[-1]["id"]]))
+
+    def stream(self, role=None):
+        self.backend.rpc()
+        with self.backend.lock:
+            ids = list(self.backend.user_order)
+
+        for id in ids:
+            user = self.backend.user_rows.get(id)
+            if user is not None and (role is None or user["role"] == role):
+                yield dict(user)
+
+    def get_with_courses(self, id):
+        self.backend.rpc()
+        with self.backend.lock:
+            user = self.backend.user_rows.get(id)
+            courses = sorted(self.backend.index.get(id, ()))
+            return (dict(user) if user is not None else None, courses)
+
+    def put(self, user):
+        self.backend.rpc()
+        with self.backend.lock:
+            id = user.get("id") or next(self.backend.ids)
+            old = self.backend.user_rows.get(id)
+            if old is not None:
+                self.backend.subs.pop(old["sub"], None)
+
+            row = {"id": id, "role": user.get("role"), "sub": user.get("sub")}
+            if old is None:
+                bisect.insort(self.backend.user_order, id)
+            self.backend.user_rows[id] = row
+            self.backend.subs[row["sub"]] = id
+
+        self.backend.store.user_changed(row["sub"])
+        return dict(row)
+
+class MemoryCourses:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, id):
+        self.backend.rpc()
+        with self.backend.lock:
+            course = self.backend.course_rows.get(id)
+            return dict(course) if course is not None else None
+
+    def get_multi(self, ids):
+        self.backend.rpc()
+        with self.backend.lock:
+            rows = self.backend.course_rows
+            return {id: dict(rows[id]) for id in ids if id in rows}
+
+    def page(self, limit, cursor=None, filters=None, sort="subject", number=(None, None)):
+        """
+        Same contract as the Datastore backend: (courses, next cursor or
+        None). The cursor is the last (sort value, id) served.
+        """
+        if filters or number != (None, None) or sort != "subject":
+            return self._query(limit, cursor, filters or {}, sort, number)
+
+        self.backend.rpc()
+        start = 0
+        with self.backend.lock:
+            order = self.backend.course_order
+            if cursor is not None:
+                start = bisect.bisect_right(order, decode_cursor(cursor, (str, int)))
+
+            positions = order[start:start + limit]
+            courses = [dict(self.backend.course_rows[id]) for _, id in positions]
+            more = start + limit < len(order)
+
+        if not more or not positions:
+            return (courses, None)
+
+        return (courses, encode_cursor(positions[-1]))
+
+    def page_offset(self, offset, limit):
+        self.backend.rpc()
+        with self.backend.lock:
+            order = self.backend.course_order
+            courses = [dict(self.backend.course_rows[id]) for _, id in order[offset:offset + limit]]
+            return (courses, offset + limit < len(order))
+
+    def create(self, data):
+        self.backend.rpc()
+        with self.backend.lock:
+            course = {"id": next(self.backend.ids)}
+            course.update({field: data[field] for field in COURSE_FIELDS})
+            self._insert(course)
+            self.backend.update_course_index({course["instructor_id"]: ([course["id"]], [])})
+            return dict(course)
+
+    def create_many(self, rows):
+        self.backend.rpc()
+        created = []
+        with self.backend.lock:
+            for data in rows:
+                course = {"id": next(self.backend.ids)}
+                course.update({field: data[field] for field in COURSE_FIELDS})
+                self._insert(course)
+                self.backend.update_course_index({course["instructor_id"]: ([course["id"]], [])})
+                created.append(dict(course))
+
+        return created
+
+    def update(self, course, data):
+        self.backend.rpc()
+        with self.backend.lock:
+            updated = dict(course)
+            for field in COURSE_FIELDS:
+                if field in data:
+                    updated[field] = data[field]
+
+            self._remove(course["id"])
+            self._insert(updated)
+
+            if updated["instructor_id"] != course["instructor_id"]:
+                self.backend.update_course_index({
+                    course["instructor_id"]: ([], [course["id"]]),
+                    updated["instructor_id"]: ([course["id"]], [])
+                })
+
+            return dict(updated)
+
+    def delete(self, course):
+        self.backend.rpc()
+        with self.backend.lock:
+            self._remove(course["id"])
+            self.backend.update_course_index({course["instructor_id"]: ([], [course["id"]])})
+
+    def _query(self, limit, cursor, filters, sort, number):
+        """
+        Filtered or re-sorted pages scan every course, there are no
+        secondary indexes here.
+        """
+        self.backend.rpc()
+        name = sort.lstrip("-")
+        descending = sort.startswith("-")
+        low, high = number
+
+        with self.backend.lock:
+            rows = [course for course in self.backend.course_rows.values()
+                    if all(course.get(key) == value for key, value in filters.items())
+                    and (low is None or course["number"] >= low)
+                    and (high is None or course["number"] <= high)]
+
+        # ties go by id either way, like Datastore's key order
+        rows.sort(key=lambda course: course["id"])
+        rows.sort(key=lambda course: course[name], reverse=descending)
+
+        start = 0
+        if cursor is not None:
+            try:
+                value, id = decode_cursor(cursor, (None, int))
+                while start < len(rows):
+                    current = rows[start][name]
+                    if (current == value and rows[start]["id"] > id
+                            or (current < value if descending else current > value)):
+                        break
+                    start += 1
+            except (TypeError, ValueError):
+                raise InvalidCursor(cursor)
+
+        courses = [dict(course) for course in rows[start:start + limit]]
+        if start + limit >= len(rows) or not courses:
+            return (courses, None)
+
+        return (courses, encode_cursor((courses[-1][name], courses[-1]["id"])))
+
+    def _insert(self, course):
+        self.backend.course_rows[course["id"]] = course
+        bisect.insort(self.backend.course_order, (course["subject"], course["id"]))
+
+    def _remove(self, id):
+        course = self.backend.course_rows.pop(id, None)
+        if course is not None:
+            order = self.backend.course_order
+            i = bisect.bisect_left(order, (course["subject"], id))
+            if i < len(order) and order[i] == (course["subject"], id):
+                del order[i]
+
+class MemoryEnrollments:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def students(self, course_id):
+        self.backend.rpc()
+        with self.backend.lock:
+            return sorted(self.backend.rosters.get(course_id, ()))
+
+    def update(self, course_id, add, remove):
+        self.backend.rpc()
+        with self.backend.lock:
+            roster = self.backend.rosters.setdefault(course_id, set())
+            roster.update(add)
+            roster.difference_update(remove)
+
+            changes = {student_id: ([course_id], []) for student_id in add}
+            changes.update({student_id: ([], [course_id]) for student_id in remove})
+            self.backend.update_course_index(changes)
+
+    def add_many(self, pairs):
+        self.backend.rpc()
+        pairs = list(dict.fromkeys(pairs))
+        with self.backend.lock:
+            for course_id, student_id in pairs:
+                self.backend.rosters.setdefault(course_id, set()).add(student_id)
+                self.backend.update_course_index({student_id: ([course_id], [])})
+
+        return len(pairs)
+
+    def page(self, limit, cursor=None):
+        """
+        (course_id, student_id) pairs in order, cursor is the last pair served.
+        """
+        self.backend.rpc()
+        after = decode_cursor(cursor, (int, int)) if cursor is not None else None
+
+        pairs = []
+        with self.backend.lock:
+            course_ids = sorted(self.backend.rosters)
+            start = bisect.bisect_left(course_ids, after[0]) if after else 0
+            for course_id in course_ids[start:]:
+                for student_id in sorted(self.backend.rosters[course_id]):
+                    if after and (course_id, student_id) <= after:
+                        continue
+                    pairs.append((course_id, student_id))
+                    if len(pairs) == limit:
+                        return (pairs, encode_cursor(pairs[-1]))
+
+        return (pairs, None)
+
+    def remove_all(self, course_id, student_ids):
+        self.backend.rpc()
+        with self.backend.lock:
+            roster = self.backend.rosters.get(course_id, set())
+            roster.difference_update(student_ids)
+            if not roster:
+                self.backend.rosters.pop(course_id, None)
+
+            self.backend.update_course_index({student_id: ([], [course_id])
+                                              for student_id in student_ids})
+            return len(student_ids)
+
+class MemoryAvatars:
+    """
+    Avatar bytes in a dict, same interface as the Cloud Storage AvatarStore.
+    """
+    def __init__(self, backend, app):
+        self.backend = backend
+        self.sizes = tuple(app.config.get('AVATAR_SIZES', ()))
+        self.chunk_size = app.config.get('AVATAR_CHUNK_SIZE', 256 * 1024)
+        self.generations = itertools.count(1)
+        self.blobs = {}
+
+    def warm(self):
+        pass
+
+    def path(self, id, size=None):
+        if size is None:
+            return f"users/{id}/avatar.png"
+
+        return f"users/{id}/avatar_{size}.png"
+
+    def exists(self, id):
+        self.backend.rpc()
+        return self.path(id) in self.blobs
+
+    def with_avatars(self, ids):
+        self.backend.rpc()
+        return {id for id in ids if self.path(id) in self.blobs}
+
+    def upload(self, id, variants):
+        self.backend.rpc()
+        with self.backend.lock:
+            for size, data in variants.items():
+                md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+                self.blobs[self.path(id, size)] = (next(self.generations), md5, data)
+
+    def stat(self, id, size=None):
+        self.backend.rpc()
+        name = self.path(id, size)
+        entry = self.blobs.get(name)
+        if entry is None:
+            return None
+
+        generation, md5, data = entry
+        return BlobInfo(name, generation, md5, len(data))
+
+    def read(self, blob):
+        entry = self.blobs.get(blob.name)
+        if entry is None or entry[0] != blob.generation:
+            return None
+
+        return entry[2]
+
+    def stream(self, blob, start=0, stop=None):
+        data = self.read(blob) or b""
+        stop = len(data) if stop is None else stop
+        for i in range(start, stop, self.chunk_size):
+            yield data[i:min(i + self.chunk_size, stop)]
+
+    def signed_url(self, id, expires, size=None):
+        # nothing to sign, the route streams instead
+        return None
+
+    def delete(self, id):
+        self.backend.rpc()
+        with self.backend.lock:
+            for size in (None,) + self.sizes:
+                self.blobs.pop(self.path(id, size), None)
+
+    def stats(self):
+        return {"blobs": len(self.blobs)}
+
+    def collectors(self):
+        return [("avatars", self.stats, ("blobs",))]
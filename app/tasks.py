@@ -0,0 +1,32 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class TaskQueue:
+    """
+    Runs slow follow-up work (cascade deletes) off the request thread.\n
+    Local in-process implementation: work still queued when the instance 
+    shuts down is lost, so tasks must be safe to re-run.
+    """
+    def __init__(self):
+        self.app = None
+        self._executor = None
+
+    def init_app(self, app):
+        self.app = app
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config.get('TASK_WORKERS', 2),
+            thread_name_prefix="tasks"
+        )
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        with self.app.app_context():
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                logger.exception("background task %s failed", fn.__name__)
+                raise
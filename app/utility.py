@@ -1,17 +1,31 @@
+import hashlib
 import json
+import secrets
+import time
 from jose import jwt
-from six.moves.urllib.request import urlopen
-from app import client, AuthError
-from flask import jsonify, current_app
+from app import store, key_store, token_cache, principal_cache, AuthError
+from flask import Response, jsonify, current_app, request, g, has_request_context
 
 ERROR = {
     "invalid": ({"Error": "The request body is invalid"}, 400),
+    "query": ({"Error": "This combination of filters and sort isn't supported"}, 400),
     "unauthorized": ({"Error": "Unauthorized"}, 401),
     "permission": ({"Error": "You don't have permission on this resource"}, 403),
     "found": ({"Error": "Not found"}, 404),
-    "data": ({"Error": "Enrollment data is invalid"}, 409)
+    "data": ({"Error": "Enrollment data is invalid"}, 409),
+    "large": ({"Error": "The file is too large"}, 413),
+    "upstream": ({"Error": "The login service failed"}, 502),
+    "unavailable": ({"Error": "The login service is unavailable"}, 503),
+    "deadline": ({"Error": "The request ran out of time"}, 503)
 }
 
+# most ids one bulk request may ask for
+GET_LIMIT = 1000
+
+# stands in for request.host_url in cached bodies, so one entry serves every
+# Host; random per process, so no stored value can contain it
+CACHED_HOST_URL = f"https://{secrets.token_hex(16)}.invalid/"
+
 def verify_jwt(request):
     if 'Authorization' in request.headers:
         auth_header = request.headers['Authorization'].split()
@@ -21,9 +35,13 @@ def verify_jwt(request):
                         "description":
                         "Authorization header is missing"}, 
                         401)
-    
-    jsonurl = urlopen("https://"+ current_app.config['DOMAIN'] +"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+
+    # already verified and not yet expired
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(digest)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -38,17 +56,8 @@ def verify_jwt(request):
                         "Invalid header. "
                         "Use an RS256 signed JWT Access Token"}, 
                         401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-    if rsa_key:
+    rsa_key = key_store.get_key(unverified_header.get("kid"))
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
@@ -71,12 +80,115 @@ def verify_jwt(request):
                                 "Unable to parse authentication"
                                 " token."}, 401)
 
+        cache_verified(digest, payload)
         return payload
     else:
         raise AuthError({"code": "no_rsa_key",
                             "description":
                                 "No RSA key in JWKS"}, 401)
 
+def cache_verified(digest, payload):
+    """
+    Caches a verified payload until exp or TOKEN_CACHE_TTL, whichever is first.
+    """
+    ttl = current_app.config['TOKEN_CACHE_TTL']
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        ttl = min(ttl, exp - time.time())
+
+    if ttl > 0:
+        token_cache.set(digest, payload, ttl)
+
+def cached_json(entry):
+    """
+    Response for a ResponseCache (etag, body) entry: 304 if the client has
+    it already, otherwise the body with this request's host in its links.
+    Edge caches may keep it COURSE_MAX_AGE.
+    """
+    etag, body = entry
+    host_url = json.dumps(request.host_url)[1:-1]
+    body = body.replace(CACHED_HOST_URL.encode(), host_url.encode())
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={current_app.config['COURSE_MAX_AGE']}"
+    }
+
+    # 304 - client's copy is current
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    return Response(body, 200, headers, mimetype="application/json")
+
+def json_body(data):
+    """
+    data serialized exactly as jsonify would.
+    """
+    return current_app.json.response(data).get_data()
+
+def loaded(kind):
+    """
+    This request's {id: entity or None} for kind, None outside a request.
+    """
+    if not has_request_context():
+        return None
+
+    entities = g.get("_entities")
+    if entities is None:
+        entities = g._entities = {}
+
+    return entities.setdefault(kind, {})
+
+def remember(kind, id, entity):
+    """
+    Puts an entity (or None once it's gone) into this request's reads.
+    """
+    memo = loaded(kind)
+    if memo is not None:
+        memo[id] = entity
+
+def load_user(id):
+    """
+    store.users.get, at most once per id per request.
+    """
+    memo = loaded("users")
+    if memo is None:
+        return store.users.get(id)
+
+    if id not in memo:
+        memo[id] = store.users.get(id)
+
+    return memo[id]
+
+def load_users(ids):
+    """
+    store.users.get_multi for the ids this request hasn't read yet.
+    Returns {id: user} for the ones that exist.
+    """
+    memo = loaded("users")
+    if memo is None:
+        return store.users.get_multi(ids)
+
+    missing = [id for id in ids if id not in memo]
+    if missing:
+        found = store.users.get_multi(missing)
+        for id in missing:
+            memo[id] = found.get(id)
+
+    return {id: memo[id] for id in ids if memo[id] is not None}
+
+def load_course(id):
+    """
+    store.courses.get, at most once per id per request.
+    """
+    memo = loaded("courses")
+    if memo is None:
+        return store.courses.get(id)
+
+    if id not in memo:
+        memo[id] = store.courses.get(id)
+
+    return memo[id]
+
 def attribute_check(attributes, data):
     for attribute in attributes:
         if attribute not in data:
@@ -85,7 +197,7 @@ def attribute_check(attributes, data):
     return None
 
 def invalid_user(id, expected_role="instructor"):
-    user = client.get(key=client.key("users", id))
+    user = load_user(id)
     if user:
         if user.get("role") == expected_role:
             return None
@@ -101,30 +213,24 @@ def no_result():
 def no_id_found():
     return ERROR["permission"]
 
-def jwt_invalid(request):
-    try:
-        payload = verify_jwt(request)
-        sub = payload.get("sub")
-        return [sub, False]
-    except AuthError:
-        return [ERROR["unauthorized"], True]
-
-def permission(sub, sub2=None):
-    query = client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    results = list(query.fetch())
-    for result in results:
-        if result.get("role") == "admin":
-            return None
-        
-    if sub == sub2:
-        return None
-        
-    return ERROR["permission"]
+def principal(sub):
+    """
+    Resolves a JWT sub to (user id, role), or None if no user has it.
+    """
+    cached = principal_cache.get(sub)
+    if cached is not None:
+        return cached or None
+
+    user = store.users.by_sub(sub)
+
+    # () caches the miss too
+    resolved = (user["id"], user.get("role")) if user else ()
+    principal_cache.set(sub, resolved)
+    return resolved or None
 
 def role_check(id, role="admin"):
-    user = client.get(key=client.key("users", id))
-    if user.get("role") != role:
+    user = load_user(id)
+    if user is None or user.get("role") != role:
         return ERROR["invalid"]
     
     return None
@@ -132,5 +238,20 @@ def role_check(id, role="admin"):
 def missing():
     return ERROR["invalid"]
 
+def unsupported_query():
+    return ERROR["query"]
+
 def enrollment_invalid():
     return ERROR["data"]
+
+def too_large():
+    return ERROR["large"]
+
+def upstream_error():
+    return ERROR["upstream"]
+
+def upstream_unavailable():
+    return ERROR["unavailable"]
+
+def out_of_time():
+    return ERROR["deadline"]
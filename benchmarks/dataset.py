@@ -0,0 +1,52 @@
+import random
+
+# (users, courses, enrollments) per named size
+SIZES = {
+    "small": (100, 20, 500),
+    "medium": (1000, 200, 5000),
+    "large": (10000, 2000, 50000)
+}
+
+SUBJECTS = ["CS", "MATH", "PHYS", "CHEM", "BIO", "ECE", "ME", "HIST", "ENG", "ART"]
+
+def seed(store, users, courses, enrollments, seed=493):
+    """
+    Fills store with one admin, users - 1 split 1:9 between instructors and
+    students, courses spread over the instructors and enrollments spread
+    over the courses. Returns the ids the benchmarks aim at.
+    """
+    rng = random.Random(seed)
+
+    admin = store.users.put({"role": "admin", "sub": "admin"})
+
+    instructors, students = [], []
+    for i in range(1, users):
+        role = "instructor" if i % 10 == 0 else "student"
+        user = store.users.put({"role": role, "sub": f"{role}-{i}"})
+        (instructors if role == "instructor" else students).append(user)
+
+    course_ids = []
+    for i in range(courses):
+        course = store.courses.create({
+            "subject": rng.choice(SUBJECTS),
+            "number": 100 + i % 400,
+            "title": f"Course {i}",
+            "term": rng.choice(["fall-24", "winter-25", "spring-25"]),
+            "instructor_id": instructors[i % len(instructors)]["id"]
+        })
+        course_ids.append(course["id"])
+
+    # same roster size everywhere, so per-course work doesn't depend on luck
+    per_course = min(enrollments // courses, len(students))
+    for course_id in course_ids:
+        roster = rng.sample(students, per_course)
+        store.enrollments.update(course_id, [s["id"] for s in roster], [])
+
+    return {
+        "admin": admin,
+        "instructor": instructors[0],
+        "student": students[0],
+        "students": students,
+        "course_id": course_ids[0],
+        "course_ids": course_ids
+    }
@@ -0,0 +1,416 @@
+"""
+Endpoint benchmarks.\n
+Drives every route through the Flask test client against the in-memory
+backend (BACKEND=memory) with a stubbed JWKS and Auth0, over synthetic
+datasets of increasing size. Reports throughput, p50/p95/p99 and backend
+calls per request for each endpoint and size, compares them with a stored
+baseline, and checks that get_courses, update_enrollment and get_user stay
+sub-linear in data size.\n
+Backend calls are counted by the memory backend and don't depend on the
+machine, so any increase over the baseline fails. Sub-millisecond timings
+from another machine are too noisy to gate on: slowdowns over the
+tolerance and more than --min-delta-ms are printed, and only fail the run
+with --strict-timings (same machine, ideally with --latency-ms).
+
+    python -m benchmarks.run                      # small + medium vs baseline
+    python -m benchmarks.run --sizes small,medium,large --requests 500
+    python -m benchmarks.run --save               # write a new baseline
+    python -m benchmarks.run --latency-ms 5       # model Datastore RPCs
+
+Exits 1 on extra backend calls, unexpected statuses or a SCALING route
+growing too fast, so it can gate CI.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+from PIL import Image
+from . import dataset, stubs
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# the routes whose cost has to stay flat as the data grows
+SCALING = ["get_courses", "update_enrollment", "get_user"]
+
+# lines per bulk import request
+BULK_LINES = 20
+
+def avatar_file():
+    data = io.BytesIO()
+    Image.new("RGB", (320, 320), (200, 80, 40)).save(data, "JPEG")
+    return data.getvalue()
+
+class Bench:
+    """
+    One app plus one seeded dataset. Each case returns the request to time;
+    anything it does before returning is setup and isn't timed.
+    """
+    def __init__(self, size, latency_ms):
+        os.environ.update({
+            "BACKEND": "memory",
+            "DOMAIN": stubs.DOMAIN,
+            "CLIENT_ID": stubs.AUDIENCE,
+            "ALGORITHMS": "RS256",
+            "MEMORY_LATENCY_MS": "0"
+        })
+
+        import app
+        self.app_module = app
+        self.app = app.create_app()
+        self.client = self.app.test_client()
+
+        # never hit the network for keys
+        app.key_store.load(stubs.jwks(), ttl=10 ** 9)
+        app.token_cache.clear()
+        app.principal_cache.clear()
+
+        self.store = app.store
+        self.size = size
+        self.ids = dataset.seed(self.store, *dataset.SIZES[size])
+
+        # seeding runs without latency, requests get the configured amount
+        self.store.backend.latency = latency_ms / 1000
+
+        self.admin = stubs.headers("admin")
+        self.instructor = stubs.headers(self.ids["instructor"]["sub"])
+        self.student = stubs.headers(self.ids["student"]["sub"])
+        self.avatar = avatar_file()
+
+        course_id = self.ids["course_id"]
+        roster = set(self.store.enrollments.students(course_id))
+        self.toggle = next(s["id"] for s in self.ids["students"] if s["id"] not in roster)
+
+        # a cursor from the middle of the course list
+        half = max(len(self.ids["course_ids"]) // 2, 1)
+        self.cursor = self.store.courses.page(half)[1]
+
+        # bulk imports re-send the same lines: enrollments land in a course
+        # of their own, so re-imports are no-op puts and rosters stay put
+        self.bulk_course = self.store.courses.create({
+            "subject": "BENCH", "number": 0, "title": "Bulk", "term": "fall-24",
+            "instructor_id": self.ids["instructor"]["id"]
+        })["id"]
+        self.enrollment_lines = "".join(
+            json.dumps({"course_id": self.bulk_course, "student_id": s["id"]}) + "\n"
+            for s in self.ids["students"][:BULK_LINES])
+        self.course_lines = "".join(
+            json.dumps({"subject": "BULK", "number": n, "title": "Bulk", "term": "fall-24",
+                        "instructor_id": self.ids["instructor"]["id"]}) + "\n"
+            for n in range(BULK_LINES))
+
+        self.store.avatars.upload(self.ids["student"]["id"],
+                                  {None: self.avatar, **{s: self.avatar for s in self.store.avatars.sizes}})
+
+    def cases(self):
+        return {
+            "login": self.login,
+            "get_users": self.get_users,
+            "lookup_users": self.lookup_users,
+            "get_user": self.get_user,
+            "get_user_admin": self.get_user_admin,
+            "create_avatar": self.create_avatar,
+            "get_avatar": self.get_avatar,
+            "delete_avatar": self.delete_avatar,
+            "create_course": self.create_course,
+            "get_courses": self.get_courses,
+            "get_courses_offset": self.get_courses_offset,
+            "get_course": self.get_course,
+            "update_course": self.update_course,
+            "delete_course": self.delete_course,
+            "update_enrollment": self.update_enrollment,
+            "get_enrollments": self.get_enrollments,
+            "get_courses_filtered": self.get_courses_filtered,
+            "get_courses_sorted": self.get_courses_sorted,
+            "decode": self.decode,
+            "metrics": self.metrics,
+            "warmup": self.warmup,
+            "export_courses": self.export_courses,
+            "export_enrollments": self.export_enrollments,
+            "import_enrollments": self.import_enrollments,
+            # last, each request adds BULK_LINES courses
+            "import_courses": self.import_courses
+        }
+
+    def login(self, i):
+        return ("POST", "/users/login",
+                {"json": {"username": "admin", "password": "x"}}, 200)
+
+    def get_users(self, i):
+        return ("GET", "/users", {"headers": self.admin}, 200)
+
+    def lookup_users(self, i):
+        ids = ",".join(str(s["id"]) for s in self.ids["students"][:50])
+        return ("GET", f"/users?ids={ids}&avatar=true", {"headers": self.admin}, 200)
+
+    def get_user(self, i):
+        return ("GET", f"/users/{self.ids['student']['id']}", {"headers": self.student}, 200)
+
+    def get_user_admin(self, i):
+        return ("GET", f"/users/{self.ids['instructor']['id']}", {"headers": self.admin}, 200)
+
+    def create_avatar(self, i):
+        data = {"file": (io.BytesIO(self.avatar), "avatar.jpg")}
+        return ("POST", f"/users/{self.ids['student']['id']}/avatar",
+                {"headers": self.student, "data": data}, 200)
+
+    def get_avatar(self, i):
+        return ("GET", f"/users/{self.ids['student']['id']}/avatar",
+                {"headers": self.student}, 200)
+
+    def delete_avatar(self, i):
+        id = self.ids["student"]["id"]
+        self.store.avatars.upload(id, {None: self.avatar})
+        return ("DELETE", f"/users/{id}/avatar", {"headers": self.student}, 204)
+
+    def create_course(self, i):
+        body = {"subject": "BENCH", "number": i, "title": "Bench", "term": "fall-24",
+                "instructor_id": self.ids["instructor"]["id"]}
+        return ("POST", "/courses", {"headers": self.admin, "json": body}, 201)
+
+    def get_courses(self, i):
+        # time the query, not a ResponseCache hit on the same page
+        self.app_module.course_cache.entries.clear()
+        return ("GET", f"/courses?cursor={self.cursor}&limit=10", {}, 200)
+
+    def get_courses_offset(self, i):
+        self.app_module.course_cache.entries.clear()
+        return ("GET", "/courses?offset=10&limit=10", {}, 200)
+
+    def get_course(self, i):
+        self.app_module.course_cache.entries.clear()
+        return ("GET", f"/courses/{self.ids['course_id']}", {}, 200)
+
+    def update_course(self, i):
+        return ("PATCH", f"/courses/{self.ids['course_id']}",
+                {"headers": self.admin, "json": {"title": f"Course {i}"}}, 200)
+
+    def delete_course(self, i):
+        course = self.store.courses.create({
+            "subject": "BENCH", "number": i, "title": "Bench", "term": "fall-24",
+            "instructor_id": self.ids["instructor"]["id"]
+        })
+        roster = [s["id"] for s in self.ids["students"][:25]]
+        self.store.enrollments.update(course["id"], roster, [])
+        return ("DELETE", f"/courses/{course['id']}", {"headers": self.admin}, 204)
+
+    def update_enrollment(self, i):
+        # alternately enroll and disenroll one student, the roster stays put
+        change = [self.toggle]
+        body = {"add": change, "remove": []} if i % 2 == 0 else {"add": [], "remove": change}
+        return ("PATCH", f"/courses/{self.ids['course_id']}/students",
+                {"headers": self.instructor, "json": body}, 200)
+
+    def get_enrollments(self, i):
+        return ("GET", f"/courses/{self.ids['course_id']}/students",
+                {"headers": self.instructor}, 200)
+
+    def get_courses_filtered(self, i):
+        self.app_module.course_cache.entries.clear()
+        return ("GET", "/courses?term=fall-24&sort=-number&limit=10", {}, 200)
+
+    def get_courses_sorted(self, i):
+        self.app_module.course_cache.entries.clear()
+        return ("GET", "/courses?sort=-number&limit=10", {}, 200)
+
+    def decode(self, i):
+        return ("GET", "/decode", {"headers": self.student}, 200)
+
+    def metrics(self, i):
+        return ("GET", "/metrics", {}, 200)
+
+    def warmup(self, i):
+        # the catalog step fills the page, time the query each run
+        self.app_module.course_cache.entries.clear()
+        return ("GET", "/_ah/warmup", {}, 200)
+
+    def export_courses(self, i):
+        return ("GET", "/bulk/courses", {"headers": self.admin}, 200)
+
+    def export_enrollments(self, i):
+        return ("GET", "/bulk/enrollments", {"headers": self.admin}, 200)
+
+    def import_enrollments(self, i):
+        return ("POST", "/bulk/enrollments",
+                {"headers": self.admin, "data": self.enrollment_lines}, 200)
+
+    def import_courses(self, i):
+        return ("POST", "/bulk/courses",
+                {"headers": self.admin, "data": self.course_lines}, 200)
+
+def measure(bench, case, requests, warmup):
+    """
+    Times requests calls of case. Returns the summary for one endpoint.
+    """
+    samples = []
+    errors = 0
+    calls = 0
+    backend = bench.store.backend
+    for i in range(warmup + requests):
+        method, path, kwargs, expected = case(i)
+
+        before = backend.calls
+        start = time.perf_counter()
+        response = bench.client.open(path, method=method, **kwargs)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+
+        if i < warmup:
+            continue
+
+        samples.append(elapsed)
+        calls += backend.calls - before
+        if response.status_code != expected:
+            errors += 1
+
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / sum(samples), 1),
+        "calls": round(calls / requests, 2),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3)
+    }
+
+def run(sizes, endpoints, requests, warmup, latency_ms):
+    results = {}
+    for size in sizes:
+        bench = Bench(size, latency_ms)
+        cases = bench.cases()
+        for name in endpoints or cases:
+            results[f"{name}@{size}"] = measure(bench, cases[name], requests, warmup)
+            print(format_row(name, size, results[f"{name}@{size}"]), flush=True)
+
+    return results
+
+def format_row(name, size, result):
+    return (f"{name:<20} {size:<7} {result['rps']:>9} rps  "
+            f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  "
+            f"p99 {result['p99_ms']:>8} ms  calls {result['calls']:>6}  "
+            f"errors {result['errors']}")
+
+def regressions(results, baseline):
+    """
+    Endpoints making more backend calls per request than the baseline.
+    """
+    found = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is not None and "calls" in old and result["calls"] > old["calls"]:
+            found.append(f"{key} calls {old['calls']} -> {result['calls']}")
+
+    return found
+
+def slowdowns(results, baseline, tolerance, min_delta_ms):
+    """
+    Endpoints whose p50 or p95 is both more than tolerance and min_delta_ms
+    over the baseline.
+    """
+    found = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+
+        for metric in ("p50_ms", "p95_ms"):
+            if (result[metric] > old[metric] * (1 + tolerance)
+                    and result[metric] - old[metric] > min_delta_ms):
+                found.append(f"{key} {metric} {old[metric]} -> {result[metric]}")
+
+    return found
+
+def scaling(results, sizes, max_exponent):
+    """
+    Fits p50 ~ data size ^ exponent between the smallest and largest size
+    run. Returns the endpoints at or over max_exponent.
+    """
+    if len(sizes) < 2:
+        return []
+
+    small, large = sizes[0], sizes[-1]
+    growth = math.log(dataset.SIZES[large][0] / dataset.SIZES[small][0])
+
+    found = []
+    for name in SCALING:
+        a, b = results.get(f"{name}@{small}"), results.get(f"{name}@{large}")
+        if a is None or b is None:
+            continue
+
+        exponent = math.log(b["p50_ms"] / a["p50_ms"]) / growth
+        print(f"{name:<20} p50 grows as size^{exponent:.2f} ({small} -> {large})")
+        if exponent >= max_exponent:
+            found.append(f"{name} scales as size^{exponent:.2f}")
+
+    return found
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tarpaulin endpoint benchmarks")
+    parser.add_argument("--sizes", default="small,medium",
+                        help=f"comma separated, from {', '.join(dataset.SIZES)}")
+    parser.add_argument("--endpoints", default="", help="comma separated, default all")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="simulated backend latency per repository call")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown over the baseline, 0.5 = 50%%")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="a slowdown also has to be at least this many ms to count")
+    parser.add_argument("--strict-timings", action="store_true",
+                        help="fail on slowdowns too, not just report them")
+    parser.add_argument("--max-exponent", type=float, default=0.5,
+                        help="fail if a SCALING route's p50 grows this fast with size")
+    parser.add_argument("--save", action="store_true", help="write results as the baseline")
+    parser.add_argument("--output", help="also write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    sizes = [size for size in args.sizes.split(",") if size]
+    endpoints = [name for name in args.endpoints.split(",") if name]
+
+    # login and warmup talk to Auth0
+    with mock.patch("requests.Session.post", stubs.auth0_post), \
+            mock.patch("requests.Session.head", stubs.auth0_head):
+        results = run(sizes, endpoints, args.requests, args.warmup, args.latency_ms)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    failures = scaling(results, sizes, args.max_exponent)
+
+    slower = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures += regressions(results, baseline)
+        slower = slowdowns(results, baseline, args.tolerance, args.min_delta_ms)
+
+    if args.strict_timings:
+        failures += slower
+    else:
+        for slowdown in slower:
+            print(f"SLOWER {slowdown}")
+
+    failures += [f"{key} had {result['errors']} unexpected statuses"
+                 for key, result in results.items() if result["errors"]]
+
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
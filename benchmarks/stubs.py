@@ -0,0 +1,72 @@
+import time
+import rsa
+from jose import jwk, jwt
+
+KID = "bench"
+AUDIENCE = "bench-client"
+DOMAIN = "bench.invalid"
+
+_private = None
+_jwks = None
+_issued = {}
+
+def signing_key():
+    """
+    A throwaway RSA key, generated once per process.
+    """
+    global _private, _jwks
+    if _private is None:
+        _, private = rsa.newkeys(2048)
+        _private = private.save_pkcs1().decode()
+        public = jwk.construct(_private, "RS256").public_key().to_dict()
+        public = {k: (v.decode() if isinstance(v, bytes) else v) for k, v in public.items()}
+        public.update({"kid": KID, "use": "sig"})
+        _jwks = {"keys": [public]}
+
+    return _private
+
+def jwks():
+    signing_key()
+    return _jwks
+
+def token(sub, ttl=3600):
+    claims = {
+        "sub": sub,
+        "aud": AUDIENCE,
+        "iss": f"https://{DOMAIN}/",
+        "exp": int(time.time()) + ttl
+    }
+    return jwt.encode(claims, signing_key(), algorithm="RS256", headers={"kid": KID})
+
+def headers(sub):
+    return {"Authorization": f"Bearer {token(sub)}"}
+
+class LoginResponse:
+    """
+    What the login route reads off the Auth0 /oauth/token response.
+    """
+    status_code = 200
+
+    def __init__(self, username):
+        self.username = username
+
+    def json(self):
+        # signing is the IdP's cost, not ours
+        if self.username not in _issued:
+            _issued[self.username] = token(self.username)
+        return {"id_token": _issued[self.username]}
+
+def auth0_post(session, url, json=None, **kwargs):
+    """
+    Stands in for requests.Session.post.
+    """
+    return LoginResponse(json["username"])
+
+class WarmResponse:
+    status_code = 200
+
+def auth0_head(session, url, **kwargs):
+    """
+    Stands in for requests.Session.head, what /_ah/warmup sends Auth0.
+    """
+    return WarmResponse()
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import threading
+import unittest
+from concurrent.futures import Executor, Future
+from unittest import mock
+from benchmarks import stubs
+
+os.environ.update({
+    "BACKEND": "memory",
+    "DOMAIN": stubs.DOMAIN,
+    "CLIENT_ID": stubs.AUDIENCE,
+    "ALGORITHMS": "RS256"
+})
+
+import app
+from app.asgi import ASGIAdapter
+from app.routes import bulk
+
+class ThreadPerCall(Executor):
+    """
+    Runs every call on a new thread: the worst case of a pool handing a
+    response's chunks to whichever thread is free.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as error:
+                future.set_exception(error)
+
+        self.calls += 1
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return future
+
+def call(adapter, method, path, body=b"", headers=None):
+    """
+    One request through the adapter. Returns (status, headers, body, messages).
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode())
+                    for name, value in (headers or {}).items()]
+    }
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(adapter(scope, receive, send))
+
+    start = sent[0]
+    data = b"".join(message.get("body", b"") for message in sent[1:])
+    return (start["status"], dict(start["headers"]), data, sent)
+
+class ASGIAdapterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = app.create_app()
+        app.key_store.load(stubs.jwks(), ttl=10 ** 9)
+        app.store.users.put({"sub": "admin", "role": "admin"})
+        cls.instructor = app.store.users.put({"sub": "instructor", "role": "instructor"})["id"]
+        cls.admin = stubs.headers("admin")
+
+    def setUp(self):
+        self.executor = ThreadPerCall()
+        self.adapter = ASGIAdapter(self.app, workers=1)
+        self.adapter.executor = self.executor
+
+    def test_buffered_response(self):
+        status, headers, data, sent = call(self.adapter, "GET", "/courses?limit=2")
+
+        self.assertEqual(status, 200)
+        self.assertIn("courses", json.loads(data))
+        # small bodies go out in one message
+        self.assertEqual(len(sent), 2)
+
+    def test_streamed_response_keeps_request_context(self):
+        lines = [{"subject": "ASGI", "number": number, "title": "Adapter", "term": "fall-24",
+                  "instructor_id": self.instructor} for number in range(3)]
+        body = "".join(json.dumps(line) + "\n" for line in lines).encode()
+
+        # chunked, so no Content-Length. One result chunk per line, each
+        # pulled on another thread.
+        with mock.patch.object(bulk, "BULK_BATCH", 1):
+            status, headers, data, sent = call(self.adapter, "POST", "/bulk/courses", body,
+                                               {**self.admin, "Content-Type": bulk.NDJSON,
+                                                "Transfer-Encoding": "chunked"})
+
+        self.assertEqual(status, 200)
+        results = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual([result["status"] for result in results], [201, 201, 201])
+        self.assertEqual(sent[-1], {"type": "http.response.body", "body": b""})
+        # the app call, a next() per chunk and the end, then close()
+        self.assertGreaterEqual(self.executor.calls, 6)
+
+    def test_request_headers_and_query(self):
+        status, headers, data, sent = call(self.adapter, "GET", "/users?limit=1", headers=self.admin)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(data)["users"]), 1)
+
+if __name__ == "__main__":
+    unittest.main()